@@ -4,9 +4,11 @@ import threading
 import json
 import uuid
 import socket
+from Lib import codec as msgcodec
+import Lib.mkmessage as mkmsg
 
 class AMQclass():
-    def __init__(self,ipaddr,idname,password,whoami,exchange):
+    def __init__(self,ipaddr,idname,password,whoami,exchange,prefetch_count=0,ack_batch=1,confirm_window=0,codec='json',publisher_confirms=True):
         self.ipaddr=ipaddr
         self.id=idname
         self.pw=password
@@ -17,13 +19,38 @@ class AMQclass():
         self.channel = None
         self.connection = None
         self.futures = {}
+        self.bound_keys = set()
+        self.qiterator = None
+        self.closing = False
+        # Consumer flow control: prefetch_count=0 leaves deliveries unbounded,
+        # ack_batch>1 acknowledges every ack_batch messages with one multiple-ack,
+        # and a partial batch is acknowledged after ack_delay seconds.
+        self.prefetch_count = prefetch_count
+        self.ack_batch = ack_batch
+        if prefetch_count > 0:
+            self.ack_batch = min(ack_batch, prefetch_count)
+        self.ack_delay = 0.5
+        self.ack_timer = None
+        self.last_unacked = None
+        self.nunacked = 0
+        # Outgoing wire format; incoming messages are decoded by their content_type
+        self.codec = msgcodec.get_codec(codec)
+        # Publisher confirms are on unless publisher_confirms=False. Each publish
+        # waits for its confirm; with confirm_window>0 up to confirm_window
+        # publishes may instead be in flight (send_message(..., wait=False)).
+        self.publisher_confirms = publisher_confirms
+        self.confirm_window = confirm_window if publisher_confirms else 0
+        self.inflight = None
+        self.pending = set()
         self.stop_event = None
         self.mission = False
         self.heartbeat_interval = 60
 
     async def connect(self):
         self.connection = await aio_pika.connect_robust(host=self.ipaddr,login=self.id,password=self.pw,heartbeat=self.heartbeat_interval)
-        self.channel = await self.connection.channel()
+        self.channel = await self.connection.channel(publisher_confirms=self.publisher_confirms)
+        if self.confirm_window > 0:
+            self.inflight = asyncio.Semaphore(self.confirm_window)
         react='RabbitMQ server connected'
         print(react, flush=True)
         return react
@@ -31,9 +58,27 @@ class AMQclass():
     async def disconnect(self):
         """Safely disconnect the RabbitMQ connection and close channels."""
         try:
+            # Fail RPC callers still waiting for a reply
+            for future in self.futures.values():
+                if not future.done():
+                    future.cancel()
+            self.futures.clear()
+
+            # Wait for outstanding publisher confirms
+            await self.flush_publishes()
+
+            # Stop the long-lived consumer before the queue goes away
+            self.closing = True
+            await self.flush_acks()
+            if self.qiterator:
+                await self.qiterator.close()
+                self.qiterator = None
+
             # Unbind and delete the queue if it exists
             if self.queue:
-                await self.queue.unbind(self.cmd_exchange)
+                for key in self.bound_keys:
+                    await self.queue.unbind(self.cmd_exchange,routing_key=key)
+                self.bound_keys.clear()
                 await self.queue.delete()
                 print("Queue unbound and deleted.", flush=True)
 
@@ -55,26 +100,205 @@ class AMQclass():
         print(react, flush=True)
         return react
 
-    async def send_message(self, _routing_key, message):
-        await self.cmd_exchange.publish(
-                aio_pika.Message(body=message.encode()),
-                routing_key=_routing_key,
-            )
-        dict_data=json.loads(message)
-        print(f"\033[32m[{self.im}] sent message to device '{_routing_key}'. message: {dict_data['message']}\033[0m", flush=True)
+    async def send_message(self, _routing_key, message, wait=True, **properties):
+        """Publish message (mkmessage object, dict, or JSON string) to _routing_key.
+
+        With a confirm_window and wait=False the publish is pipelined:
+        this returns a task resolving to the broker confirmation (or raising
+        its failure) once a slot in the in-flight window is free. Extra keyword
+        arguments are set as AMQP message properties.
+        """
+        if isinstance(message, mkmsg.Message):
+            text = message.message
+            body = aio_pika.Message(body=self.codec.encode(message.to_dict()), content_type=self.codec.content_type, **properties)
+        elif isinstance(message, dict):
+            text = message.get('message')
+            body = aio_pika.Message(body=self.codec.encode(message), content_type=self.codec.content_type, **properties)
+        else:
+            text = None
+            body = aio_pika.Message(body=message.encode(), content_type=msgcodec.JSONCodec.content_type, **properties)
+
+        if self.inflight is None:
+            await self.cmd_exchange.publish(body, routing_key=_routing_key)
+        elif wait:
+            async with self.inflight:
+                await self.cmd_exchange.publish(body, routing_key=_routing_key)
+        else:
+            await self.inflight.acquire()
+            task = asyncio.create_task(self.publish_confirmed(_routing_key, body, text))
+            self.pending.add(task)
+            task.add_done_callback(self.pending.discard)
+            return task
+
+        self.print_sent(_routing_key, text)
+
+    async def call(self, _routing_key, payload, timeout=None):
+        """Send payload as a request and await the matching 'Done' reply.
+
+        The request is stamped with a fresh corrid (also set as the AMQP
+        correlation_id, with reply_to); the reply is delivered by resolve()
+        regardless of how many other calls are pending. Raises
+        asyncio.TimeoutError if no reply arrives within timeout seconds.
+        """
+        corrid = uuid.uuid4().hex
+        request = payload.to_dict() if isinstance(payload, mkmsg.Message) else dict(payload)
+        request['corrid'] = corrid
+        future = asyncio.get_running_loop().create_future()
+        self.futures[corrid] = future
+        try:
+            await self.send_message(_routing_key, request, correlation_id=corrid, reply_to=self.im)
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.futures.pop(corrid, None)
+
+    def resolve(self, response):
+        """Hand a received reply to its waiting call(). Returns True if consumed."""
+        if response.process != 'Done':
+            return False
+        future = self.futures.get(response.corrid)
+        if future is None or future.done():
+            return False
+        future.set_result(response)
+        return True
+
+    async def publish_confirmed(self, _routing_key, body, text):
+        try:
+            confirm = await self.cmd_exchange.publish(body, routing_key=_routing_key)
+        except Exception as e:
+            print(f"\033[31m[{self.im}] message to device '{_routing_key}' was not confirmed: {e}. message: {text}\033[0m", flush=True)
+            raise
+        finally:
+            self.inflight.release()
+        self.print_sent(_routing_key, text)
+        return confirm
+
+    async def flush_publishes(self):
+        """Wait for every pipelined publish and return their results (or exceptions)."""
+        if not self.pending:
+            return []
+        return await asyncio.gather(*self.pending, return_exceptions=True)
+
+    def print_sent(self, _routing_key, text):
+        if text is None:
+            print(f"\033[32m[{self.im}] sent message to device '{_routing_key}'.\033[0m", flush=True)
+        else:
+            print(f"\033[32m[{self.im}] sent message to device '{_routing_key}'. message: {text}\033[0m", flush=True)
 
     async def define_consumer(self):
         if self.queue is None:
+            if self.prefetch_count > 0:
+                await self.channel.set_qos(prefetch_count=self.prefetch_count)
             self.cmd_exchange = await self.channel.declare_exchange(self.exchange, aio_pika.ExchangeType.DIRECT)
             self.queue = await self.channel.declare_queue(f'{self.im}_queue',durable=True)
 
+    async def bind(self,_routing_key):
+        """Bind the consumer queue to the exchange once per routing key."""
+        if _routing_key not in self.bound_keys:
+            await self.queue.bind(self.cmd_exchange,routing_key=_routing_key)
+            self.bound_keys.add(_routing_key)
+
+    async def open_iterator(self):
+        """Start a single queue iterator that stays open for the client lifetime."""
+        if self.qiterator is None:
+            self.qiterator = self.queue.iterator()
+            await self.qiterator.consume()
+        return self.qiterator
+
     async def receive_message(self,_routing_key):
-        await self.queue.bind(self.cmd_exchange,routing_key=_routing_key)
-        async with self.queue.iterator() as qiterator:
-            async for message in qiterator:
-                async with message.process():
-                    print(f'\n{_routing_key} Server received message', flush=True) #, message.body.decode())
-                    return message.body
+        await self.bind(_routing_key)
+        qiterator = await self.open_iterator()
+        while True:
+            message = await qiterator.__anext__()
+            await self.ack(message)
+            msg = self.decode(message, _routing_key)
+            if msg is not None:
+                print(f'\n{_routing_key} Server received message', flush=True) #, message.body.decode())
+                return msg
+
+    def decode(self, message, _routing_key):
+        """Decode and validate an incoming delivery; invalid messages are reported and dropped."""
+        try:
+            return mkmsg.from_dict(msgcodec.decode(message.body, message.content_type))
+        except (ValueError, TypeError, AttributeError) as e:
+            print(f'[{self.im}] dropped invalid message on {_routing_key}: {e}', flush=True)
+            return None
+
+    async def ack(self,message):
+        """Acknowledge message, either at once or as part of a multiple-ack batch."""
+        if self.ack_batch <= 1:
+            await message.ack()
+            return
+        self.last_unacked = message
+        self.nunacked += 1
+        if self.nunacked >= self.ack_batch:
+            await self.flush_acks()
+        elif self.ack_timer is None:
+            # Do not leave a partial batch unacked while the queue is idle
+            self.ack_timer = asyncio.get_running_loop().call_later(
+                self.ack_delay, lambda: asyncio.ensure_future(self.flush_acks()))
+
+    async def flush_acks(self):
+        """Acknowledge every delivery up to the last received one in a single frame."""
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        if self.last_unacked is not None:
+            message = self.last_unacked
+            self.last_unacked = None
+            self.nunacked = 0
+            await message.ack(multiple=True)
+
+    async def reopen_iterator(self):
+        """Drop the current queue iterator so the next receive opens a new one."""
+        qiterator, self.qiterator = self.qiterator, None
+        # Delivery tags of the old consumer cannot be acknowledged any more
+        if self.ack_timer is not None:
+            self.ack_timer.cancel()
+            self.ack_timer = None
+        self.last_unacked = None
+        self.nunacked = 0
+        if qiterator is not None:
+            try:
+                await qiterator.close()
+            except Exception:
+                pass
+
+    async def consume(self,_routing_key):
+        """Yield received messages for _routing_key from the persistent consumer.
+
+        A failure while receiving one message (ack, decode, a channel error
+        during reconnect) is reported and consumption goes on. An iterator
+        that stops on its own (a channel closed, or a reconnect taking longer
+        than aio_pika waits) is replaced by a new one; consumption ends only
+        after disconnect().
+        """
+        while True:
+            try:
+                msg = await self.receive_message(_routing_key)
+            except StopAsyncIteration:
+                if self.closing:
+                    return
+                print(f'[{self.im}] consumer on {_routing_key} stopped; reopening it', flush=True)
+                await self.reopen_iterator()
+                await asyncio.sleep(1)
+                continue
+            except Exception as e:
+                print(f'[{self.im}] error while receiving on {_routing_key}: {e}', flush=True)
+                await asyncio.sleep(1)
+                continue
+            yield msg
+
+    async def start_consumer(self,_routing_key,callback):
+        """Hand every received message for _routing_key to the coroutine callback."""
+        await self.bind(_routing_key)
+
+        async def on_message(message):
+            await self.ack(message)
+            msg = self.decode(message, _routing_key)
+            if msg is not None:
+                await callback(msg)
+
+        return await self.queue.consume(on_message)
 
 #    async def start_guidingloop(self, _routing_key,itmax,function,subserver):    ### For autoguiding
 #        itn=0
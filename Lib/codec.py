@@ -0,0 +1,49 @@
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+class JSONCodec():
+    content_type = 'application/json'
+
+    def encode(self, dict_data):
+        return json.dumps(dict_data).encode()
+
+    def decode(self, body):
+        return json.loads(body)
+
+
+class MsgpackCodec():
+    content_type = 'application/msgpack'
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("msgpack is required for the 'msgpack' codec: pip install msgpack")
+
+    def encode(self, dict_data):
+        return msgpack.packb(dict_data, use_bin_type=True)
+
+    def decode(self, body):
+        return msgpack.unpackb(body, raw=False)
+
+
+CODECS = {'json': JSONCodec, 'msgpack': MsgpackCodec}
+decoders = {}
+
+
+def get_codec(name):
+    """Return the codec registered as name ('json' or 'msgpack')."""
+    try:
+        return CODECS[name]()
+    except KeyError:
+        raise ValueError(f"Unknown message codec '{name}'. Available: {', '.join(CODECS)}")
+
+
+def decode(body, content_type=None):
+    """Decode a message body according to its AMQP content_type (JSON if unset)."""
+    name = 'msgpack' if content_type == MsgpackCodec.content_type else 'json'
+    if name not in decoders:
+        decoders[name] = get_codec(name)
+    return decoders[name].decode(body)
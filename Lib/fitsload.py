@@ -0,0 +1,146 @@
+import math
+import itertools
+import numpy as np
+from astropy.io import fits
+import Lib.zscale as zs
+
+
+class FitsFrame():
+    """Memory-mapped FITS image for display.
+
+    Pixels are read from disk only when a view asks for them: zscale reads its
+    strided sample, a preview reads a decimated grid and a zoomed view reads
+    just the visible region. Raw (unscaled) data stay mapped; BSCALE/BZERO are
+    applied to the small arrays that are actually returned.
+
+    build_pyramid() adds 2x2-binned levels (read once, off the GUI thread);
+    views then take the coarsest level that still matches the requested size.
+    """
+    def __init__(self, filepath, hdu=0):
+        self.filepath = filepath
+        self.hdul = fits.open(filepath, memmap=True, do_not_scale_image_data=True)
+        header = self.hdul[hdu].header
+        self.raw = self.hdul[hdu].data
+        self.bscale = header.get('BSCALE', 1.0)
+        self.bzero = header.get('BZERO', 0.0)
+        self.shape = self.raw.shape
+        self.levels = []        # levels[k-1] is binned by 2**k
+        # Never reused, unlike id(), so caches can key on it
+        self.token = next(tokens)
+
+    def close(self):
+        self.raw = None
+        self.levels = []
+        self.hdul.close()
+
+    def scaled(self, raw):
+        """Physical values for a block of raw pixels (copied out of the memmap)."""
+        if self.bscale == 1.0 and self.bzero == 0.0:
+            return np.array(raw)
+        return raw * np.float32(self.bscale) + np.float32(self.bzero)
+
+    def zscale(self, **kwargs):
+        """(z1, z2) from the strided zscale sample of the mapped data."""
+        z1, z2 = zs.zscale(self.raw, **kwargs)
+        z1, z2 = float(z1) * self.bscale + self.bzero, float(z2) * self.bscale + self.bzero
+        return (z1, z2) if z1 <= z2 else (z2, z1)
+
+    def build_pyramid(self, mode='mean', minsize=512, rows=1024):
+        """Build 2x2 mean- (or max-) binned levels down to minsize pixels.
+
+        Level 1 is accumulated in blocks of rows so the full-resolution frame
+        is never held in memory at once.
+        """
+        ny, nx = self.shape
+        if min(ny, nx) // 2 < minsize:
+            return
+        rows -= rows % 2
+        level = np.empty((ny // 2, nx // 2), dtype=np.float32)
+        for r in range(0, ny - ny % 2, rows):
+            block = self.scaled(self.raw[r:min(r + rows, ny - ny % 2)])
+            level[r // 2:r // 2 + block.shape[0] // 2] = bin2(block, mode)
+        self.levels = [level]
+        while min(level.shape) // 2 >= minsize:
+            level = bin2(level, mode)
+            self.levels.append(level)
+
+    def view(self, x0, x1, y0, y1, width, height):
+        """Pixels of the region x0..x1, y0..y1 decimated to about width x height.
+
+        Returns (data, extent) with extent in full-resolution pixel
+        coordinates, ready for imshow(..., extent=extent, origin='lower').
+        """
+        return self.read(self.plan(x0, x1, y0, y1, width, height))
+
+    def plan(self, x0, x1, y0, y1, width, height):
+        """Integer (level, x0, x1, y0, y1, step) that view() reads for a region.
+
+        Views that resolve to the same plan return the same pixels, so the plan
+        is what render caches key on.
+        """
+        ny, nx = self.shape
+        x0, x1 = max(0, int(math.floor(x0))), min(nx, int(math.ceil(x1)))
+        y0, y1 = max(0, int(math.floor(y0))), min(ny, int(math.ceil(y1)))
+        x1, y1 = max(x1, x0 + 1), max(y1, y0 + 1)
+        step = max(1, (x1 - x0) // max(1, width), (y1 - y0) // max(1, height))
+
+        # Coarsest pyramid level not coarser than step, then stride within it
+        k = min(int(math.log2(step)), len(self.levels))
+        if k > 0:
+            binning = 2 ** k
+            step //= binning
+            x0, y0 = x0 // binning, y0 // binning
+            x1, y1 = max(x0 + 1, x1 // binning), max(y0 + 1, y1 // binning)
+        return (k, x0, x1, y0, y1, step)
+
+    def read(self, plan):
+        """(data, extent) for a plan from plan()."""
+        k, x0, x1, y0, y1, step = plan
+        if k == 0:
+            data = self.scaled(self.raw[y0:y1:step, x0:x1:step])
+        else:
+            binning = 2 ** k
+            data = self.levels[k - 1][y0:y1:step, x0:x1:step]
+            x0, y0, step = x0 * binning, y0 * binning, step * binning
+        extent = (x0 - 0.5, x0 + data.shape[1] * step - 0.5, y0 - 0.5, y0 + data.shape[0] * step - 0.5)
+        return data, extent
+
+    def preview(self, width=1024, height=1024):
+        """Decimated view of the whole frame."""
+        return self.read(self.preview_plan(width, height))
+
+    def preview_plan(self, width=1024, height=1024):
+        return self.plan(0, self.shape[1], 0, self.shape[0], width, height)
+
+
+tokens = itertools.count()
+ARMS = ('B', 'R')
+
+
+def open_arms(filepath, arms=ARMS):
+    """{arm: FitsFrame} for the blue and red arms of a frame file.
+
+    A file whose image HDUs carry EXTNAME B and R gives one frame per arm.
+    Otherwise every arm maps to the same FitsFrame of the primary image, so
+    anything keyed on the frame (see Lib.render) is shared between them.
+    """
+    with fits.open(filepath, memmap=True) as hdul:
+        names = [hdu.name.upper() for hdu in hdul]
+    if all(arm in names for arm in arms):
+        return {arm: FitsFrame(filepath, hdu=names.index(arm)) for arm in arms}
+    frame = FitsFrame(filepath)
+    return {arm: frame for arm in arms}
+
+
+def close_arms(frames):
+    for frame in {id(frame): frame for frame in frames.values()}.values():
+        frame.close()
+
+
+def bin2(data, mode='mean'):
+    """Bin a 2-d array by 2x2 (mean or max), dropping an odd last row/column."""
+    ny, nx = data.shape[0] // 2, data.shape[1] // 2
+    blocks = data[:2 * ny, :2 * nx].reshape(ny, 2, nx, 2)
+    if mode == 'max':
+        return blocks.max(axis=(1, 3)).astype(np.float32, copy=False)
+    return blocks.mean(axis=(1, 3), dtype=np.float32)
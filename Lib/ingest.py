@@ -0,0 +1,67 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+
+class Superseded(Exception):
+    """The job was replaced by a newer one before its result was used."""
+
+
+class LatestOnly():
+    """Run ingest jobs in a worker pool, keeping only the newest one.
+
+    Starting a job supersedes the previous one: its awaiter gets Superseded
+    as soon as the newer job is submitted, and the job itself can stop early
+    by checking the stale() callable it is given. Cancelling the awaiting
+    task still raises asyncio.CancelledError (and marks the job stale).
+
+    A result that is never returned, because its job was superseded or
+    cancelled after it finished or while it was still running, is handed to
+    discard(result) so the resources it holds can be released.
+    """
+    def __init__(self, max_workers=2):
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingest')
+        self.generation = 0
+        self.current = None
+
+    async def run(self, func, *args, discard=None):
+        """Run func(stale, *args) in the pool and return its result."""
+        self.generation += 1
+        generation = self.generation
+        if self.current is not None and not self.current.done():
+            self.current.cancel()
+
+        def stale():
+            return generation != self.generation
+
+        job = self.pool.submit(func, stale, *args)
+        future = asyncio.wrap_future(job)
+        self.current = future
+        try:
+            result = await future
+        except asyncio.CancelledError:
+            self.drop(job, discard)
+            if stale() and not asyncio.current_task().cancelling():
+                raise Superseded from None
+            if not stale():
+                self.generation += 1    # Let the job see it is no longer wanted
+            raise
+        if stale():
+            self.drop(job, discard)
+            raise Superseded
+        return result
+
+    @staticmethod
+    def drop(job, discard):
+        # Release the job's result once it exists (now, or from the worker thread)
+        if discard is None:
+            return
+
+        def release(job):
+            if not job.cancelled() and job.exception() is None and job.result() is not None:
+                discard(job.result())
+
+        job.add_done_callback(release)
+
+    def shutdown(self):
+        self.generation += 1
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,83 @@
+import os
+import logging
+from collections import deque
+from logging.handlers import RotatingFileHandler
+from PySide6.QtCore import QTimer
+
+FORMAT = '%(asctime)s %(levelname)s %(message)s'
+WIDGET_FORMAT = '%(asctime)s %(message)s'
+DATEFMT = '%H:%M:%S'
+DEFAULTS = {'logfile': './LOG/ics.log', 'max_bytes': 5_000_000, 'backup_count': 10,
+            'file_level': 'DEBUG', 'widget_level': 'INFO', 'widget_max_lines': 5000, 'widget_max_fps': 4}
+
+
+class WidgetHandler(logging.Handler):
+    """Logging handler that feeds a QPlainTextEdit in batches.
+
+    Records are buffered and appended in one block at most max_fps times per
+    second. The buffer and the widget both keep only the last max_lines
+    lines, so a night of progress messages costs no more than a few.
+    """
+    def __init__(self, widget, max_lines=5000, max_fps=4, level=logging.INFO):
+        super().__init__(level)
+        self.widget = widget
+        self.widget.setMaximumBlockCount(max_lines)
+        self.buffer = deque(maxlen=max_lines)
+        self.setFormatter(logging.Formatter(WIDGET_FORMAT, DATEFMT))
+        # A free-running timer rather than one started per record, so records
+        # from worker threads are picked up too
+        self.timer = QTimer(widget)
+        self.timer.setInterval(1000 // max_fps)
+        self.timer.timeout.connect(self.flush)
+        self.timer.start()
+
+    def emit(self, record):
+        try:
+            self.buffer.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        lines = []
+        while self.buffer:
+            lines.append(self.buffer.popleft())
+        if lines:
+            self.widget.appendPlainText('\n'.join(lines))
+
+    def close(self):
+        try:
+            self.timer.stop()
+            self.flush()
+        except RuntimeError:
+            pass        # Widget already deleted (close from logging.shutdown at exit)
+        super().close()
+
+
+def setup_logging(widget, options=None, name='ICS'):
+    """Return the logger name, writing to widget and to a rotating file.
+
+    options (the LOG section of KSPEC.ini) override DEFAULTS: the log file,
+    its size and backup count, the levels for file and widget and the widget
+    line cap and refresh rate.
+    """
+    options = dict(DEFAULTS, **(options or {}))
+    logger = logging.getLogger(name)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    logger.addHandler(WidgetHandler(widget, options['widget_max_lines'], options['widget_max_fps'],
+                                    level=options['widget_level']))
+    try:
+        os.makedirs(os.path.dirname(options['logfile']) or '.', exist_ok=True)
+        filehandler = RotatingFileHandler(options['logfile'], maxBytes=options['max_bytes'],
+                                          backupCount=options['backup_count'], encoding='utf-8')
+    except OSError as e:
+        print(f'Could not open log file {options["logfile"]}: {e}')
+    else:
+        filehandler.setLevel(options['file_level'])
+        filehandler.setFormatter(logging.Formatter(FORMAT))
+        logger.addHandler(filehandler)
+    return logger
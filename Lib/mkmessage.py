@@ -1,52 +1,139 @@
 import json
 
-def common():
-    dict_data={'inst': 'None', 'func' : 'None', 'savedata': 'False', 'filename': 'None', 'process': 'ING', 'message': 'None',
-            'script': 'False','status': 'fail'}
-    return dict_data
+# Fields shared by every K-SPEC message and their defaults. Unset values are
+# native None/False, so JSON (null/false) and msgpack carry them alike.
+COMMON = {'inst': None, 'func' : None, 'savedata': False, 'filename': None, 'process': 'ING', 'message': None,
+        'script': False,'status': 'fail', 'corrid': None}
 
+
+class Message():
+    """Base ICS message. Subclasses set INST and add their own fields in EXTRA."""
+    __slots__ = tuple(COMMON)
+    INST = None
+    EXTRA = {}
+
+    def __init__(self, **fields):
+        for name, value in self.DEFAULTS.items():
+            setattr(self, name, value)
+        if fields:
+            self.update(**fields)
+
+    def __init_subclass__(cls):
+        super().__init_subclass__()
+        cls.DEFAULTS = dict(COMMON, inst=cls.INST, **cls.EXTRA)
+        cls.FIELDS = tuple(cls.DEFAULTS)
+        REGISTRY[cls.INST] = cls
+
+    def update(self, *args, **fields):
+        """Set fields like dict.update, rejecting names the message does not have.
+
+        Everything is checked before anything is set, so a rejected update
+        leaves the message unchanged.
+        """
+        fields = dict(*args, **fields)
+        for name in fields:
+            if name not in self.DEFAULTS:
+                raise ValueError(f"{self.INST} message has no field '{name}'")
+        if fields.get('inst', self.INST) != self.INST:
+            raise ValueError(f"{type(self).__name__} cannot carry inst '{fields['inst']}'")
+        for name, value in fields.items():
+            setattr(self, name, value)
+
+    def to_dict(self):
+        """Return the wire representation of the message."""
+        return {name: getattr(self, name) for name in self.FIELDS}
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def __repr__(self):
+        return f'{type(self).__name__}({self.to_dict()!r})'
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(getattr(self, n) == getattr(other, n) for n in self.FIELDS)
+
+
+Message.DEFAULTS = dict(COMMON)
+Message.FIELDS = tuple(COMMON)
+REGISTRY = {}
+
+
+class GFAMessage(Message):
+    __slots__ = ()
+    INST = 'GFA'
+
+
+class EndoMessage(Message):
+    __slots__ = ()
+    INST = 'ENDO'
+
+
+class ADCMessage(Message):
+    EXTRA = {'zdist': None,'RA': None, 'DEC': None}
+    __slots__ = tuple(EXTRA)
+    INST = 'ADC'
+
+
+class FBPMessage(Message):
+    __slots__ = ()
+    INST = 'FBP'
+
+
+class LampMessage(Message):
+    __slots__ = ()
+    INST = 'LAMP'
+
+
+class MTLMessage(Message):
+    __slots__ = ()
+    INST = 'MTL'
+
+
+class SpecMessage(Message):
+    EXTRA = {'time': None,'numframe': None,'file': None}
+    __slots__ = tuple(EXTRA)
+    INST = 'SPEC'
+
+
+def from_dict(dict_data):
+    """Build the typed message for a decoded wire dict. Raises ValueError if invalid.
+
+    Keys the message type does not define (e.g. added by a newer subsystem)
+    are ignored rather than rejecting the whole message.
+    """
+    if not isinstance(dict_data, dict):
+        raise ValueError(f"Message is not an object: {type(dict_data).__name__}")
+    try:
+        cls = REGISTRY[dict_data['inst']]
+    except (KeyError, TypeError):
+        raise ValueError(f"Unknown or missing instrument in message: {dict_data.get('inst')!r}") from None
+    msg = cls()
+    msg.update({name: value for name, value in dict_data.items() if name in cls.DEFAULTS})
+    return msg
+
+
+def from_json(text):
+    return from_dict(json.loads(text))
+
+
+# Factory names kept for existing callers.
 def gfamsg():
-    dict_data=common()
-    dict_data.update(inst='GFA')
-    return dict_data
+    return GFAMessage()
 
 def endomsg():
-    dict_data=common()
-    dict_data.update(inst='ENDO')
-    return dict_data
+    return EndoMessage()
 
 def adcmsg():
-    dict_data=common()
-    update_data={'zdist': 'None','RA': 'None', 'DEC': 'None'}
-    dict_data.update(update_data)
-    dict_data.update(inst='ADC')
-    return dict_data
+    return ADCMessage()
 
 def fbpmsg():
-    dict_data=common()
-#    update_data={'zdist': 'None'}
-#    dict_data.update(update_data)
-    dict_data.update(inst='FBP')
-    return dict_data
+    return FBPMessage()
 
 def lampmsg():
-    dict_data=common()
-#    update_data={'zdist': 'None'}
-#    dict_data.update(update_data)
-    dict_data.update(inst='LAMP')
-    return dict_data
+    return LampMessage()
 
 def mtlmsg():
-    dict_data=common()
-    update_data={'time': 'None'}
-#    dict_data.update(update_data)
-    dict_data.update(inst='MTL')
-    return dict_data
+    return MTLMessage()
 
 def specmsg():
-    dict_data=common()
-    update_data={'time': 'None','numframe': 'None'}
-    dict_data.update(update_data)
-    dict_data.update(inst='SPEC')
-    return dict_data
-
+    return SpecMessage()
@@ -1,36 +1,216 @@
+import os
 import json
+import atexit
 import shutil
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 processini = "./Lib/process.ini"
 processfile = "./PROCESS/process.json"
 
-def initial():
-    shutil.copy2(processini,processfile)
-    print('Process status is initialized')
 
-    with open(processfile,'r') as f:
-        process_status=json.load(f)
-    f.close()
+class ProcessStore():
+    """Process status of every subsystem, held in memory and shared through processfile.
 
-def update_process(inst,status):
-    with open(processfile,'r') as f:
-        process_status=json.load(f)
+    Several processes (the ICS and the subsystem servers) share the file, so
+    the store never writes its whole state over it: a write re-reads the file
+    and applies only the keys this process changed (under an flock where
+    available), then replaces it atomically. Writes are debounced to at most
+    one per delay seconds. Reads are served from memory and re-read the file
+    only when its mtime or size changed, so other processes' updates are
+    seen at the cost of a stat.
 
-    f.close()
+    The file is read on first use, not at import. Subscribers are called with
+    (inst, status) for every change made here or picked up from the file, in
+    the thread that made or noticed it, after the lock is released.
+    """
+    def __init__(self, path=processfile, initpath=processini, delay=0.5):
+        self.path = path
+        self.initpath = initpath
+        self.delay = delay
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()
+        self.status = None
+        self.dirty = {}
+        self.writing = {}       # Changes being written; still ours until the file has them
+        self.seen = None
+        self.subscribers = []
+        self.timer = None
 
-    process_update={inst+'process': status}
+    def read_file(self):
+        """(status dict, stat signature) of processfile, falling back to processini."""
+        path = self.path if os.path.exists(self.path) else self.initpath
+        with open(path, 'r') as f:
+            stat = os.fstat(f.fileno())
+            status = json.load(f)
+        signature = (path, stat.st_mtime_ns, stat.st_size) if path == self.path else None
+        return status, signature
 
-    process_status.update(process_update)
+    def refresh(self):
+        """Pick up changes made by other processes. Returns the (inst, status) changes."""
+        try:
+            stat = os.stat(self.path)
+            if self.status is not None and self.seen == (self.path, stat.st_mtime_ns, stat.st_size):
+                return []
+        except OSError:
+            if self.status is not None:
+                return []
+        try:
+            status, signature = self.read_file()
+        except (OSError, ValueError) as e:
+            print(f'Could not read process status: {e}')
+            status, signature = {}, None
+        with self.lock:
+            old = self.status or {}
+            # Changes of our own not yet written win over the file
+            status.update(self.writing)
+            status.update(self.dirty)
+            self.status = status
+            self.seen = signature
+            return self.changes(old, status)
 
-    with open(processfile,'w') as f:
-        json.dump(process_status,f)
+    @staticmethod
+    def changes(old, new):
+        return [(key[:-len('process')], value) for key, value in new.items()
+                if key.endswith('process') and old.get(key) != value]
 
-    f.close()
+    def get(self, inst):
+        changes = self.refresh()
+        self.notify(changes)
+        return self.status[inst + 'process']
 
-def get_process(inst):
-    with open(processfile,'r') as f:
-        process_status=json.load(f)
+    def snapshot(self):
+        self.notify(self.refresh())
+        with self.lock:
+            return dict(self.status)
+
+    def apply(self, statuses):
+        # Caller holds the lock; returns the changes to notify once it is released
+        changed = [(inst, status) for inst, status in statuses.items()
+                   if self.status.get(inst + 'process') != status]
+        for inst, status in changed:
+            self.status[inst + 'process'] = status
+            self.dirty[inst + 'process'] = status
+        if changed:
+            self.schedule_write()
+        return changed
+
+    def update(self, statuses):
+        """Set several {inst: status} at once."""
+        changes = self.refresh()
+        with self.lock:
+            changes += self.apply(statuses)
+        self.notify(changes)
+
+    def set(self, inst, status):
+        self.update({inst: status})
+
+    def swap(self, inst, expected, status):
+        """Set inst to status only if it is currently expected. Returns whether it did."""
+        changes = self.refresh()
+        with self.lock:
+            done = self.status.get(inst + 'process') == expected
+            if done:
+                changes += self.apply({inst: status})
+        self.notify(changes)
+        return done
+
+    def reset(self):
+        """Overwrite processfile with processini and reload it, dropping unwritten changes."""
+        with self.lock:
+            self.cancel_write()
+            self.dirty = {}
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            shutil.copy2(self.initpath, self.path)
+            self.seen = None
+        self.notify(self.refresh())
+
+    def subscribe(self, callback):
+        """Call callback(inst, status) on every change. Returns a function that cancels the subscription."""
+        self.subscribers.append(callback)
+        return lambda: self.subscribers.remove(callback)
+
+    def notify(self, changes):
+        for inst, status in changes:
+            for callback in list(self.subscribers):
+                try:
+                    callback(inst, status)
+                except Exception as e:
+                    print(f'Process status subscriber failed on {inst}={status}: {e}')
+
+    def schedule_write(self):
+        with self.lock:
+            if self.timer is None:
+                self.timer = threading.Timer(self.delay, self.write)
+                self.timer.daemon = True
+                self.timer.start()
 
-    f.close()
-    prostat=process_status[inst+'process']
+    def cancel_write(self):
+        with self.lock:
+            timer, self.timer = self.timer, None
+        if timer is not None:
+            timer.cancel()
+        return timer is not None
+
+    def write(self):
+        """Merge this process's changed keys into processfile."""
+        with self.write_lock:
+            with self.lock:
+                self.timer = None
+                dirty, self.dirty = self.dirty, {}
+                self.writing = dirty
+            if not dirty:
+                return
+            try:
+                os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+                with open(self.path + '.lock', 'w') as lockfile:
+                    if fcntl is not None:
+                        fcntl.flock(lockfile, fcntl.LOCK_EX)
+                    status, _ = self.read_file()
+                    status.update(dirty)
+                    tmpname = f'{self.path}.{os.getpid()}.part'
+                    with open(tmpname, 'w') as f:
+                        json.dump(status, f)
+                    os.replace(tmpname, self.path)
+                    stat = os.stat(self.path)
+            except (OSError, ValueError) as e:
+                print(f'Could not write process status {self.path}: {e}')
+                with self.lock:
+                    # Keep the changes for the next attempt
+                    self.dirty = dict(dirty, **self.dirty)
+                    self.writing = {}
+                return
+            with self.lock:
+                self.writing = {}
+                # What was just written is what we hold, apart from newer changes
+                old = self.status or {}
+                status.update(self.dirty)
+                self.status = status
+                self.seen = (self.path, stat.st_mtime_ns, stat.st_size)
+                changes = self.changes(old, status)
+            self.notify(changes)
+
+    def flush(self):
+        """Write pending changes now."""
+        if self.cancel_write() or self.dirty:
+            self.write()
+
+
+store = ProcessStore()
+atexit.register(store.flush)
+
+
+def initial():
+    store.reset()
+    print('Process status is initialized')
+
+def update_process(inst,status):
+    store.set(inst, status)
+
+def get_process(inst):
+    prostat=store.get(inst)
     return prostat
@@ -0,0 +1,52 @@
+import threading
+from collections import OrderedDict
+import numpy as np
+import matplotlib
+
+
+class RenderCache():
+    """Colormapped RGBA views of FitsFrames, shared by every canvas showing them.
+
+    Entries are keyed by (frame token, clim, cmap, plan) where plan is the
+    FitsFrame.plan() of the region, so canvases showing the same frame with the
+    same limits pay for one read and one normalize/colormap pass between them.
+    Renders may be made from the ingest pool as well as the GUI thread.
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, frame, plan, clim, cmap='gray'):
+        """Return (rgba, extent) of frame.read(plan) mapped through clim and cmap."""
+        key = (frame.token, tuple(clim), cmap, plan)
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            self.misses += 1
+
+        data, extent = frame.read(plan)
+        rendered = (colorize(data, clim, cmap), extent)
+        with self.lock:
+            self.entries[key] = rendered
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        return rendered
+
+    def forget(self, frame):
+        """Drop the renders of a frame that is being closed."""
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == frame.token]:
+                del self.entries[key]
+
+
+def colorize(data, clim, cmap='gray'):
+    """uint8 RGBA image of data scaled linearly between clim (as imshow would draw it)."""
+    vmin, vmax = clim
+    scale = 1.0 / (vmax - vmin) if vmax != vmin else 0.0
+    normed = (np.asarray(data, dtype=np.float32) - np.float32(vmin)) * np.float32(scale)
+    return matplotlib.colormaps[cmap](normed, bytes=True)
@@ -0,0 +1,122 @@
+import asyncio
+import inspect
+
+
+class Route():
+    """One destination of the Router: an asyncio.Queue or a handler."""
+    __slots__ = ('name', 'target', 'count', 'deliver')
+
+    def __init__(self, name, target):
+        self.name = name
+        self.target = target
+        self.count = 0
+        if isinstance(target, asyncio.Queue):
+            # The router runs in the single consumer coroutine: a queue whose
+            # put() can wait for good would hold up every other route behind it
+            if target.maxsize > 0 and getattr(target, 'policy', 'block') == 'block' \
+                    and getattr(target, 'timeout', None) is None:
+                raise ValueError(f"Route '{name}': a bounded 'block' queue fed by the router needs a timeout")
+            self.deliver = target.put
+        elif inspect.iscoroutinefunction(target):
+            self.deliver = target
+        else:
+            self.deliver = self.call
+
+    async def call(self, msg):
+        self.target(msg)
+
+    def stats(self):
+        stats = {'count': self.count}
+        if isinstance(self.target, asyncio.Queue):
+            stats['depth'] = self.target.qsize()
+            stats['dropped'] = getattr(self.target, 'dropped', 0)
+            stats['high_water'] = getattr(self.target, 'high_water', None)
+        return stats
+
+
+class Router():
+    """Dispatch inbound messages by (inst, process).
+
+    Routes are registered once, at connect time, and looked up with one dict
+    access per message. A route registered with process=None takes every
+    process of its instrument that has no exact route; anything else goes to
+    the default route. Each route counts its messages and, for queues, reports
+    the depth, drops and high-water mark through stats().
+    """
+    def __init__(self, default):
+        self.routes = {}
+        self.default = Route('default', default)
+
+    def add(self, inst, process, target, name=None):
+        """Send messages of inst with process (None for any) to a queue or handler."""
+        name = name or (f'{inst}/{process}' if process is not None else inst)
+        self.routes[(inst, process)] = Route(name, target)
+
+    def route(self, msg):
+        routes = self.routes
+        return routes.get((msg.inst, msg.process)) or routes.get((msg.inst, None)) or self.default
+
+    async def dispatch(self, msg):
+        route = self.route(msg)
+        route.count += 1
+        await route.deliver(msg)
+
+    def stats(self):
+        """{route name: {'count', and for queues 'depth', 'dropped', 'high_water'}}."""
+        return {route.name: route.stats() for route in (*self.routes.values(), self.default)}
+
+    def summary(self):
+        parts = []
+        for name, stats in self.stats().items():
+            part = f"{name}: {stats['count']}"
+            if 'depth' in stats:
+                part += f" (queued {stats['depth']}, max {stats['high_water']}, dropped {stats['dropped']})"
+            parts.append(part)
+        return ', '.join(parts)
+
+
+POLICIES = ('block', 'drop_oldest', 'latest')
+
+
+class BoundedQueue(asyncio.Queue):
+    """asyncio.Queue with a policy for when it is full.
+
+    'block'        put() waits for room (backpressure on the consumer). With a
+                   timeout, the oldest item is dropped once it expires, so an
+                   undrained queue cannot stall the consumer for good.
+                   Router refuses bounded 'block' queues without a timeout.
+    'drop_oldest'  put() drops the oldest item to make room.
+    'latest'       only the newest item is kept (maxsize is forced to 1).
+
+    dropped counts discarded items and high_water the largest depth seen.
+    maxsize=0 is unbounded, as for asyncio.Queue.
+    """
+    def __init__(self, maxsize=0, policy='block', timeout=None):
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown queue policy '{policy}'. Available: {', '.join(POLICIES)}")
+        super().__init__(1 if policy == 'latest' else maxsize)
+        self.policy = policy
+        self.timeout = timeout
+        self.dropped = 0
+        self.high_water = 0
+
+    def drop_oldest(self):
+        self.get_nowait()
+        self.task_done()
+        self.dropped += 1
+
+    def put_nowait(self, item):
+        if self.policy != 'block' and self.full():
+            self.drop_oldest()
+        super().put_nowait(item)
+        self.high_water = max(self.high_water, self.qsize())
+
+    async def put(self, item):
+        if self.policy != 'block':
+            return self.put_nowait(item)
+        try:
+            await asyncio.wait_for(super().put(item), self.timeout)
+        except asyncio.TimeoutError:
+            if self.full():
+                self.drop_oldest()
+            self.put_nowait(item)
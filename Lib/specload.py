@@ -0,0 +1,144 @@
+import os
+import re
+import hashlib
+from collections import OrderedDict
+import numpy as np
+
+# Parsed spectra are cached in memory and as .npy files keyed by path, size and
+# mtime, so a spectrum is parsed once no matter how often it is displayed. Both
+# caches are LRU: MEMORY_CACHE_SIZE spectra in memory, DISK_CACHE_BYTES on disk
+# (a cache file's mtime is its last use).
+cachedir = os.path.join(os.path.expanduser('~'), '.cache', 'kspec', 'spectra')
+MEMORY_CACHE_SIZE = 8
+DISK_CACHE_BYTES = 512 * 1024 * 1024
+memory_cache = OrderedDict()
+
+
+def load_spectrum(path, usecols=(0, 1), skiprows=1):
+    """Return (wave, flux) of a reduced spectrum.
+
+    Text files (as written by the pipeline: a header line, then columns) are
+    parsed once and FITS tables are read through astropy (WAVE/FLUX columns,
+    or the first two). Results are cached, see cachedir.
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, tuple(usecols), skiprows)
+    if key in memory_cache:
+        memory_cache.move_to_end(key)
+        return memory_cache[key]
+
+    cachefile = None
+    if cachedir:
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        cachefile = os.path.join(cachedir, digest + '.npy')
+    if cachefile and os.path.exists(cachefile):
+        columns = np.load(cachefile)
+        try:
+            os.utime(cachefile)
+        except OSError:
+            pass
+    else:
+        if path.endswith(('.fits', '.fit', '.fits.gz')):
+            columns = read_fits_table(path)
+        else:
+            columns = read_text(path, usecols, skiprows)
+        if cachefile:
+            save_cache(cachefile, columns)
+
+    spectrum = (columns[0], columns[1])
+    memory_cache[key] = spectrum
+    while len(memory_cache) > MEMORY_CACHE_SIZE:
+        memory_cache.popitem(last=False)
+    return spectrum
+
+
+def read_text(path, usecols=(0, 1), skiprows=1):
+    """Columns usecols of a whitespace-separated table, as a 2 x N float array."""
+    # numpy >= 1.23 parses in C; the per-line Python overhead of older
+    # numpy, and of any reparse at all, is what the .npy cache removes.
+    return np.loadtxt(path, skiprows=skiprows, dtype=float, unpack=True, usecols=usecols)
+
+
+def read_fits_table(path):
+    from astropy.io import fits
+    with fits.open(path) as hdul:
+        table = hdul[1].data
+        names = [name.upper() for name in table.columns.names]
+        if 'WAVE' in names and 'FLUX' in names:
+            wave, flux = table.field(names.index('WAVE')), table.field(names.index('FLUX'))
+        else:
+            wave, flux = table.field(0), table.field(1)
+        return np.array([np.ravel(wave), np.ravel(flux)], dtype=float)
+
+
+def save_cache(cachefile, columns):
+    # Written to a temporary name and renamed so a crash never leaves half a cache file
+    try:
+        os.makedirs(os.path.dirname(cachefile), exist_ok=True)
+        tmpname = cachefile + '.part.npy'
+        np.save(tmpname, columns)
+        os.replace(tmpname, cachefile)
+        prune_cache(os.path.dirname(cachefile))
+    except OSError as e:
+        print(f'Could not write spectrum cache {cachefile}: {e}')
+
+
+def prune_cache(directory, max_bytes=None):
+    """Delete the least recently used cache files until directory holds at most max_bytes."""
+    max_bytes = DISK_CACHE_BYTES if max_bytes is None else max_bytes
+    entries = []
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.endswith('.npy') and not entry.name.endswith('.part.npy'):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+            total -= size
+        except FileNotFoundError:
+            pass
+
+
+def find_reduced(framefile, reduceddir, arms=('SDCH', 'SDCK')):
+    """Reduced spectra matching a raw frame, as {arm: path}.
+
+    Raw frames are named YYMMDDNNNN.fits and reduced ones ARM_YYYYMMDD_NNNNNN
+    (.txt or .fits). Arms without a reduced file are left out.
+    """
+    match = re.match(r'(\d{6})(\d{4,})$', os.path.splitext(os.path.basename(framefile))[0])
+    if match is None:
+        return {}
+    date, number = '20' + match.group(1), int(match.group(2))
+    found = {}
+    for arm in arms:
+        for extension in ('.txt', '.fits'):
+            path = os.path.join(reduceddir, f'{arm}_{date}_{number:06d}{extension}')
+            if os.path.exists(path):
+                found[arm] = path
+                break
+    return found
+
+
+def minmax_envelope(wave, flux, x0, x1, nbins):
+    """Points to draw wave/flux between x0 and x1 on about nbins screen pixels.
+
+    wave must be ascending. When more than 2*nbins samples are visible they
+    are split into nbins runs and each run is drawn as a vertical stroke from
+    its minimum to its maximum, so peaks and absorption lines stay visible.
+    Otherwise the raw samples are returned.
+    """
+    i0 = max(0, np.searchsorted(wave, x0, side='left') - 1)
+    i1 = min(len(wave), np.searchsorted(wave, x1, side='right') + 1)
+    if i1 - i0 <= 2 * nbins:
+        return wave[i0:i1], flux[i0:i1]
+    starts = np.linspace(0, i1 - i0, nbins, endpoint=False).astype(int)
+    segment = flux[i0:i1]
+    x = np.repeat(wave[i0:i1][starts], 2)
+    y = np.empty(2 * nbins, dtype=segment.dtype)
+    y[0::2] = np.minimum.reduceat(segment, starts)
+    y[1::2] = np.maximum.reduceat(segment, starts)
+    return x, y
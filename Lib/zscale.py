@@ -1,4 +1,6 @@
 import math
+import os
+import weakref
 import numpy
 
 MAX_REJECT = 0.5
@@ -7,19 +9,23 @@ GOOD_PIXEL = 0
 BAD_PIXEL = 1
 KREJ = 2.5
 MAX_ITERATIONS = 5
+MASK_CACHE_SIZE = 16
+
+mask_cache = {}
 
 def zscale (image, nsamples=1000, contrast=0.25, bpmask=None, zmask=None):
     """Implement IRAF zscale algorithm
     nsamples=1000 and contrast=0.25 are the IRAF display task defaults
-    bpmask and zmask not implemented yet
     image is a 2-d numpy array
+    bpmask: bad pixel mask, nonzero pixels are excluded
+    zmask: region mask, only nonzero pixels are sampled
+    masks have the image shape and may be arrays or .npy/FITS file names
     returns (z1, z2)
     """
 
     # Sample the image
-    samples = zsc_sample (image, nsamples, bpmask, zmask)
+    samples = numpy.sort(zsc_sample (image, nsamples, bpmask, zmask))
     npix = len(samples)
-    samples.sort()
     zmin = samples[0]
     zmax = samples[-1]
     # For a zero-indexed array
@@ -27,7 +33,7 @@ def zscale (image, nsamples=1000, contrast=0.25, bpmask=None, zmask=None):
     if npix%2 == 1:
         median = samples[center_pixel]
     else:
-        median = 0.5 * (samples[center_pixel] + samples[center_pixel + 1])
+        median = 0.5 * (float(samples[center_pixel]) + float(samples[center_pixel + 1]))
 
     #
     # Fit a line to the sorted array of samples
@@ -46,29 +52,190 @@ def zscale (image, nsamples=1000, contrast=0.25, bpmask=None, zmask=None):
         z2 = min (zmax, median + (npix - center_pixel) * zslope)
     return z1, z2
 
+def zscale_batch (images, nsamples=1000, contrast=0.25, bpmask=None, zmask=None):
+    """Vectorized zscale for many images at once
+    images is an N x H x W array or a list of 2-d arrays; images of equal
+    shape are sampled and fitted together in one pass
+    bpmask and zmask are as in zscale and apply to every image
+    returns a list of N (z1, z2), equal to zscale up to floating-point rounding
+    """
+    if isinstance(images, numpy.ndarray) and images.ndim == 3:
+        return zsc_batch_stack (images, nsamples, contrast, bpmask, zmask)
+
+    groups = {}
+    for i, image in enumerate(images):
+        groups.setdefault(numpy.shape(image), []).append(i)
+
+    result = [None] * len(images)
+    for index in groups.values():
+        stack = numpy.stack([images[i] for i in index])
+        for i, z in zip(index, zsc_batch_stack (stack, nsamples, contrast, bpmask, zmask)):
+            result[i] = z
+    return result
+
+def zsc_batch_stack (stack, nsamples, contrast, bpmask, zmask):
+
+    # zscale of every image in an N x H x W stack
+    nimage = stack.shape[0]
+    stride, use = zsc_grid (stack.shape[1:], nsamples, bpmask, zmask)
+    sample_stack = stack[:, ::stride, ::stride]
+    if use is None:
+        samples = sample_stack.reshape(nimage, -1)[:, :nsamples]
+    else:
+        samples = sample_stack[:, use][:, :nsamples]
+    samples = numpy.sort(samples, axis=1)
+
+    npix = samples.shape[1]
+    zmin = samples[:, 0]
+    zmax = samples[:, -1]
+    center_pixel = int((npix - 1) / 2)
+    if npix%2 == 1:
+        median = samples[:, center_pixel]
+    else:
+        median = 0.5 * (samples[:, center_pixel].astype(float) + samples[:, center_pixel + 1])
+
+    minpix = max(MIN_NPIXELS, int(npix * MAX_REJECT))
+    ngrow = max (1, int (npix * 0.01))
+    ngoodpix, zslope = zsc_fit_lines (samples, npix, KREJ, ngrow, MAX_ITERATIONS)
+
+    if contrast > 0:
+        zslope = zslope / contrast
+    z1 = numpy.maximum(zmin, median - (center_pixel - 1) * zslope)
+    z2 = numpy.minimum(zmax, median + (npix - center_pixel) * zslope)
+    fallback = ngoodpix < minpix
+    z1 = numpy.where(fallback, zmin, z1)
+    z2 = numpy.where(fallback, zmax, z2)
+    return list(zip(z1.tolist(), z2.tolist()))
+
+def zsc_fit_lines (samples, npix, krej, ngrow, maxiter):
+
+    # zsc_fit_line for each row of samples. Rows stop iterating independently
+    # once too few good pixels remain; their last fit is kept.
+    nimage = samples.shape[0]
+    xscale = 2.0 / (npix - 1)
+    xnorm = numpy.arange(npix) * xscale - 1.0
+    minpix = max (MIN_NPIXELS, int (npix*MAX_REJECT))
+
+    badpix = numpy.zeros(samples.shape, dtype=bool)
+    ngoodpix = numpy.full(nimage, npix)
+    intercept = numpy.zeros(nimage)
+    slope = numpy.zeros(nimage)
+
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        for niter in range(maxiter):
+            active = ngoodpix >= minpix
+            if not active.any():
+                break
+
+            # Straight line fit over the good pixels of every row
+            good = ~badpix
+            xgood = numpy.where(good, xnorm, 0.0)
+            ygood = numpy.where(good, samples, 0.0)
+            sumx = xgood.sum(axis=1)
+            sumxx = (xgood*xgood).sum(axis=1)
+            sumxy = (xgood*ygood).sum(axis=1)
+            sumy = ygood.sum(axis=1)
+            sum = ngoodpix
+
+            delta = sum * sumxx - sumx * sumx
+            intercept = numpy.where(active, (sumxx * sumy - sumx * sumxy) / delta, intercept)
+            slope = numpy.where(active, (sum * sumxy - sumx * sumy) / delta, slope)
+
+            # k-sigma rejection around the fitted lines
+            flat = samples - (slope[:, None] * xnorm + intercept[:, None])
+            fgood = numpy.where(good, flat, 0.0)
+            sumz = fgood.sum(axis=1)
+            sumsq = (fgood*fgood).sum(axis=1)
+            temp = sumsq / (sum - 1) - sumz*sumz / (sum * (sum - 1))
+            sigma = numpy.sqrt(numpy.maximum(temp, 0.0))
+
+            reject = numpy.abs(flat) > (sigma * krej)[:, None]
+            newbad = badpix | reject
+            if ngrow > 1:
+                newbad = zsc_grow (newbad, ngrow)
+            badpix = numpy.where(active[:, None], newbad, badpix)
+            ngoodpix = npix - numpy.count_nonzero(badpix, axis=1)
+
+    return ngoodpix, slope * xscale
+
 def zsc_sample (image, maxpix, bpmask=None, zmask=None):
 
     # Figure out which pixels to use for the zscale algorithm
     # Returns the 1-d array samples
-    # Don't worry about the bad pixel mask or zmask for the moment
     # Sample in a square grid, and return the first maxpix in the sample
-    nc = image.shape[0]
-    nl = image.shape[1]
-    stride = max (1.0, math.sqrt((nc - 1) * (nl - 1) / float(maxpix)))
-    stride = int (stride)
+    stride, use = zsc_grid (image.shape, maxpix, bpmask, zmask)
 
     sample_image = image[::stride,::stride]
 
-    masks = [numpy.zeros(sample_image.shape, dtype=bool)]
+    if use is None:
+        return sample_image.ravel()[:maxpix]
 
-    for m in [zmask, bpmask]:
-        if m is not None: 
-            masks.append(m[::stride,::stride].astype(bool))
+    samples = sample_image[use]
+    return samples[:maxpix]
 
-    msk = numpy.max(masks, axis=0)
+def zsc_grid (shape, maxpix, bpmask=None, zmask=None):
 
-    samples = sample_image[~msk]
-    return samples[:maxpix]
+    # Sampling stride for an image of this shape, and the boolean selection of
+    # usable pixels on the sampling grid (None when no mask is given).
+    nc = shape[0]
+    nl = shape[1]
+    stride = max (1.0, math.sqrt((nc - 1) * (nl - 1) / float(maxpix)))
+    stride = int (stride)
+
+    # Only the sampled grid of each mask is read (and cached)
+    use = None
+    if zmask is not None:
+        use = zsc_mask_grid (zmask, shape, stride)
+    if bpmask is not None:
+        bad = zsc_mask_grid (bpmask, shape, stride)
+        use = ~bad if use is None else use & ~bad
+
+    return stride, use
+
+def zsc_load_mask (mask):
+
+    # Masks may be arrays or file names. Files are memory-mapped, so only the
+    # pages holding sampled pixels are ever read: .npy through numpy.load,
+    # anything else as the primary HDU of a FITS file.
+    if not isinstance(mask, (str, os.PathLike)):
+        return numpy.asarray(mask)
+    if str(mask).endswith('.npy'):
+        return numpy.load(mask, mmap_mode='r')
+    from astropy.io import fits
+    with fits.open(mask, memmap=True) as hdul:
+        return hdul[0].data
+
+def zsc_mask_grid (mask, shape, stride):
+
+    # Boolean (nonzero) mask on the sampling grid, cached per mask, image shape
+    # and stride so repeated frames from the same detector reuse it.
+    # Mask arrays are treated as read-only; file masks are re-read if modified.
+    # Only the small grid is kept: an array mask is referenced weakly, to tell
+    # it apart from a later array that reuses its id().
+    if isinstance(mask, (str, os.PathLike)):
+        key = (os.fspath(mask), os.path.getmtime(mask), shape, stride)
+        ref = None
+    else:
+        key = (id(mask), shape, stride)
+        try:
+            ref = weakref.ref(mask)
+        except TypeError:
+            ref = False         # Not weakly referenceable (e.g. a list): not cached
+    cached = mask_cache.get(key)
+    if cached is not None and (cached[0] is None or cached[0]() is mask):
+        return cached[1]
+
+    data = zsc_load_mask (mask)
+    if data.shape != shape:
+        raise ValueError(f"Mask shape {data.shape} does not match image shape {shape}")
+    grid = numpy.asarray(data[::stride,::stride]) != 0
+
+    if ref is False:
+        return grid
+    if len(mask_cache) >= MASK_CACHE_SIZE:
+        del mask_cache[next(iter(mask_cache))]
+    mask_cache[key] = (ref, grid)
+    return grid
 
 def zsc_fit_line (samples, npix, krej, ngrow, maxiter):
 
@@ -81,9 +248,11 @@ def zsc_fit_line (samples, npix, krej, ngrow, maxiter):
     ngoodpix = npix
     minpix = max (MIN_NPIXELS, int (npix*MAX_REJECT))
     last_ngoodpix = npix + 1
+    intercept = 0.0
+    slope = 0.0
 
-    # This is the mask used in k-sigma clipping.  0 is good, 1 is bad
-    badpix = numpy.zeros(npix, dtype="int32")
+    # Mask used in k-sigma clipping: True marks a rejected pixel
+    badpix = numpy.zeros(npix, dtype=bool)
 
     #
     #  Iterate
@@ -94,12 +263,14 @@ def zsc_fit_line (samples, npix, krej, ngrow, maxiter):
             break
 
         # Accumulate sums to calculate straight line fit
-        goodpixels = numpy.where(badpix == GOOD_PIXEL)
-        sumx = xnorm[goodpixels].sum()
-        sumxx = (xnorm[goodpixels]*xnorm[goodpixels]).sum()
-        sumxy = (xnorm[goodpixels]*samples[goodpixels]).sum()
-        sumy = samples[goodpixels].sum()
-        sum = len(goodpixels[0])
+        good = ~badpix
+        xgood = xnorm[good]
+        ygood = samples[good]
+        sumx = xgood.sum()
+        sumxx = (xgood*xgood).sum()
+        sumxy = (xgood*ygood).sum()
+        sumy = ygood.sum()
+        sum = len(xgood)
 
         delta = sum * sumxx - sumx * sumx
         # Slope and intercept
@@ -116,21 +287,13 @@ def zsc_fit_line (samples, npix, krej, ngrow, maxiter):
         threshold = sigma * krej
 
         # Detect and reject pixels further than k*sigma from the fitted line
-        lcut = -threshold
-        hcut = threshold
-        below = numpy.where(flat < lcut)
-        above = numpy.where(flat > hcut)
-
-        badpix[below] = BAD_PIXEL
-        badpix[above] = BAD_PIXEL
+        badpix |= numpy.abs(flat) > threshold
 
-        # Convolve with a kernel of length ngrow
-        kernel = numpy.ones(ngrow,dtype="int32")
-        badpix = numpy.convolve(badpix, kernel, mode='same')
+        # Grow rejected pixels by ngrow
+        if ngrow > 1:
+            badpix = zsc_grow (badpix, ngrow)
 
-        ngoodpix = len(numpy.where(badpix == GOOD_PIXEL)[0])
-
-        niter += 1
+        ngoodpix = npix - numpy.count_nonzero(badpix)
 
     # Transform the line coefficients back to the X range [0:npix-1]
     zstart = intercept - slope
@@ -138,16 +301,29 @@ def zsc_fit_line (samples, npix, krej, ngrow, maxiter):
 
     return ngoodpix, zstart, zslope
 
+def zsc_grow (badpix, ngrow):
+
+    # Reject every pixel within the ngrow-long window around a rejected one.
+    # Same result as numpy.convolve(badpix, ones(ngrow), mode='same') > 0,
+    # but O(npix) via a cumulative sum instead of O(npix*ngrow).
+    # Works along the last axis, so a stack of masks is grown row by row.
+    npix = badpix.shape[-1]
+    csum = numpy.zeros(badpix.shape[:-1] + (npix + 1,), dtype=numpy.int64)
+    numpy.cumsum(badpix, axis=-1, out=csum[..., 1:])
+    hi = numpy.arange(npix) + (ngrow - 1) // 2
+    lo = hi - ngrow + 1
+    return csum[..., numpy.minimum(hi + 1, npix)] > csum[..., numpy.maximum(lo, 0)]
+
 def zsc_compute_sigma (flat, badpix, npix):
 
     # Compute the rms deviation from the mean of a flattened array.
-    # Ignore rejected pixels
+    # Ignore rejected pixels (badpix is True)
 
     # Accumulate sum and sum of squares
-    goodpixels = numpy.where(badpix == GOOD_PIXEL)
-    sumz = flat[goodpixels].sum()
-    sumsq = (flat[goodpixels]*flat[goodpixels]).sum()
-    ngoodpix = len(goodpixels[0])
+    fgood = flat[~badpix]
+    sumz = fgood.sum()
+    sumsq = (fgood*fgood).sum()
+    ngoodpix = len(fgood)
     if ngoodpix == 0:
         mean = None
         sigma = None
@@ -15,19 +15,26 @@ async def main():
     ip_addr = kspecinfo['RabbitMQ']['ip_addr']
     idname = kspecinfo['RabbitMQ']['idname']
     pwd = kspecinfo['RabbitMQ']['pwd']
+    prefetch_count = kspecinfo['RabbitMQ'].get('prefetch_count',0)
+    confirm_window = kspecinfo['RabbitMQ'].get('confirm_window',0)
+    codec = kspecinfo['RabbitMQ'].get('codec','json')
 
     print('SPECTRO Sever Started!!!')
-    SPEC_server=AMQclass(ip_addr,idname,pwd,'SPEC','ics.ex')
+    # Commands are acknowledged one by one (ack_batch=1): a command still unacked
+    # at a reconnect would be delivered again and re-run its exposure.
+    SPEC_server=AMQclass(ip_addr,idname,pwd,'SPEC','ics.ex',prefetch_count,1,confirm_window,codec)
     await SPEC_server.connect()
     await SPEC_server.define_consumer()
-    while True:
-        print('Waiting for message from client......')
-        msg=await SPEC_server.receive_message("SPEC")
-        dict_data=json.loads(msg)
-        message=dict_data['message']
-        print('\033[94m'+'[SPEC] received: ', message+'\033[0m')
+    print('Waiting for message from client......')
+    async for cmd in SPEC_server.consume("SPEC"):
+        try:
+            message=cmd.message
+            print('\033[94m'+'[SPEC] received: ', str(message)+'\033[0m')
 
-        await identify_execute(SPEC_server,msg)
+            await identify_execute(SPEC_server,cmd)
+        except Exception as e:
+            print(f'\033[31m[SPEC] error while handling command: {e}\033[0m')
+        print('Waiting for message from client......')
 
 
 if __name__ == "__main__":
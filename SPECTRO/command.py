@@ -1,125 +1,206 @@
 import os,sys
 from Lib.AMQ import *
 import Lib.mkmessage as mkmsg
-import json
 import asyncio
-import time
 import random
+import re
+import threading
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from astropy.io import fits
 import numpy as  np 
 
+# Command table: func -> (handler, concurrency group). A handler returns the
+# reply message text, or a dict of reply fields; run_command builds the reply.
+# Commands in the same group run one at a time; group None is never limited.
+async def do_getbias(SPEC_server,cmd):
+    return get_bias(cmd.numframe)
+
+async def do_getflat(SPEC_server,cmd):
+    return await get_flat(cmd.time,cmd.numframe)
+
+async def do_getarc(SPEC_server,cmd):
+    return await get_arc(cmd.time,cmd.numframe)
+
+async def do_getobj(SPEC_server,cmd):
+    return await get_obj(SPEC_server,float(cmd.time),int(cmd.numframe))
+
+async def do_illuon(SPEC_server,cmd):
+    return await illu_on()      ### Position of back illumination light on function
+
+async def do_illuoff(SPEC_server,cmd):
+    return await illu_off()     ### Position of back illumination light off function
+
+async def do_specstatus(SPEC_server,cmd):
+    return spec_status()
+
+COMMANDS = {
+    'getbias': (do_getbias, 'exposure'),
+    'getflat': (do_getflat, 'exposure'),
+    'getarc': (do_getarc, 'exposure'),
+    'getobj': (do_getobj, 'exposure'),
+    'illuon': (do_illuon, 'illumination'),
+    'illuoff': (do_illuoff, 'illumination'),
+    'specstatus': (do_specstatus, None),
+}
+
+GROUP_LIMITS = {'exposure': 1, 'illumination': 1}
+group_locks = {}
+running = set()
+
 async def identify_execute(SPEC_server,cmd):
-    dict_data=json.loads(cmd)
-    func=dict_data['func']
-
-    if func == 'getbias':
-        numframe=dict_data['numframe']
-        comment=get_bias(numframe) ### Position of back illumination light on function
-        reply_data=mkmsg.specmsg()
-        reply_data.update(message=comment,process='Done')
-        rsp=json.dumps(reply_data)
-        print('\033[32m'+'[SPEC]', comment+'\033[0m')
-        await SPEC_server.send_message('ICS',rsp)
-
-    if func == 'getflat':
-        exptime=dict_data['time']
-        numframe=dict_data['numframe']
-        comment=get_flat(exptime,numframe) ### Position of back illumination light on function
-        reply_data=mkmsg.specmsg()
-        reply_data.update(message=comment,process='Done')
-        rsp=json.dumps(reply_data)
-        print('\033[32m'+'[SPEC]', comment+'\033[0m')
-        await SPEC_server.send_message('ICS',rsp)
-
-    if func == 'getarc':
-        exptime=dict_data['time']
-        numframe=dict_data['numframe']
-        comment=get_arc(exptime,numframe) ### Position of back illumination light on function
-        reply_data=mkmsg.specmsg()
-        reply_data.update(message=comment,process='Done')
-        rsp=json.dumps(reply_data)
-        print('\033[32m'+'[SPEC]', comment+'\033[0m')
-        await SPEC_server.send_message('ICS',rsp)
-
-    if func == 'illuon':
-        comment=illu_on() ### Position of back illumination light on function
-        reply_data=mkmsg.specmsg()
-        reply_data.update(message=comment,process='Done')
-        rsp=json.dumps(reply_data)
-        print('\033[32m'+'[SPEC]', comment+'\033[0m')
-        await SPEC_server.send_message('ICS',rsp)
-
-    if func == 'illuoff':
-        comment=illu_off()                      ### Position of back illumination light off function
-        reply_data=mkmsg.specmsg()
-        reply_data.update(message=comment,process='Done')
-        rsp=json.dumps(reply_data)
-        print('\033[32m'+'[SPEC]', comment+'\033[0m')
-        await SPEC_server.send_message('ICS',rsp)
-
-    if func == 'getobj':
-        exptime=dict_data['time']
-        numframe=dict_data['numframe']
-        await get_obj(SPEC_server,float(exptime),int(numframe)) ### Position of all gfa camera exposure function
-
-    if func == 'specstatus':
-        comment=spec_status()
-        reply_data=mkmsg.specmsg()
-        reply_data.update(message=comment,process='Done')
-        rsp=json.dumps(reply_data)
-        print('\033[32m'+'[SPEC]', comment+'\033[0m')
-        await SPEC_server.send_message('ICS',rsp)
+    """Start cmd as its own task so long exposures never block other commands."""
+    entry = COMMANDS.get(cmd.func)
+    if entry is None:
+        msg=f"'{cmd.func}' is not right command for SPECTROGRAPH."
+        print(f"\033[31m[SPEC] {msg}\033[0m")
+        # Reply anyway, so a caller waiting on the corrid is not left to time out
+        reply_data=mkmsg.SpecMessage(message=msg,process='Done',status='fail',corrid=cmd.corrid)
+        await SPEC_server.send_message('ICS',reply_data)
+        return None
+    task = asyncio.create_task(run_command(SPEC_server,cmd,*entry))
+    running.add(task)
+    task.add_done_callback(running.discard)
+    return task
+
+async def run_command(SPEC_server,cmd,handler,group):
+    try:
+        if group is None:
+            result = await handler(SPEC_server,cmd)
+        else:
+            if group not in group_locks:
+                group_locks[group] = asyncio.Semaphore(GROUP_LIMITS[group])
+            async with group_locks[group]:
+                result = await handler(SPEC_server,cmd)
+        reply_data=mkmsg.SpecMessage(process='Done',status='success',corrid=cmd.corrid)
+        if isinstance(result,dict):
+            reply_data.update(result)
+        else:
+            reply_data.update(message=result)
+    except Exception as e:
+        reply_data=mkmsg.SpecMessage(message=f"'{cmd.func}' failed: {e}",process='Done',status='fail',corrid=cmd.corrid)
+    print('\033[32m'+'[SPEC]', str(reply_data.message)+'\033[0m')
+    await SPEC_server.send_message('ICS',reply_data)
 
 # Below functions are for simulation. When connect the instruments, please annoate.
+# They must never block the event loop (RabbitMQ heartbeats and status replies
+# run on it): wait with asyncio.sleep, and run blocking driver calls through
+# 'await asyncio.to_thread(driver_call, ...)'.
 
-def illu_on():
-    time.sleep(3)
+async def illu_on():
+    await asyncio.sleep(3)
     msg='Back illumination light on.'
     return msg
 
-def illu_off():
-    time.sleep(3)
+async def illu_off():
+    await asyncio.sleep(3)
     msg='Back illumination light off.'
     return msg
 
 async def get_obj(SPEC_server, exptime, nframe):
     msg=f'Exposure Start!!!'
-    reply_data=mkmsg.specmsg()
-    reply_data.update(message=msg,process='ING')
-    rsp=json.dumps(reply_data)
+    reply_data=mkmsg.SpecMessage(message=msg,process='ING')
     print('\033[32m'+'[SPEC]', msg+'\033[0m')
-    await SPEC_server.send_message('ICS', rsp)
+    await SPEC_server.send_message('ICS', reply_data)
 
     result= await asyncio.gather(create_fits_image(exptime),remaining(SPEC_server,exptime))
     msg=f'Exposure finished'
-    reply_data=mkmsg.specmsg()
-    reply_data.update(message=msg,process='ING')
-    rsp=json.dumps(reply_data)
+    reply_data=mkmsg.SpecMessage(message=msg,process='ING')
     print('\033[32m'+'[SPEC]', msg+'\033[0m')
-    await SPEC_server.send_message('ICS', rsp)
-
-    print(result[0])
-    reply_data=mkmsg.specmsg()
-    reply_data.update(result[0])
-    rsp=json.dumps(reply_data)
-    print('\033[32m'+'[SPEC]', reply_data["message"]+'\033[0m')
-    await SPEC_server.send_message('ICS', rsp)
-
-def get_next_filename(prefix: str = "250314", extension: str = "fits"):
-    index = 1
-    while True:
-        filename = f"./RAWDATA/{prefix}{index:04d}.{extension}"
-        if not os.path.exists(filename):
-            return filename
-        index += 1
+    await SPEC_server.send_message('ICS', reply_data)
+
+    return result[0]
+
+def observing_date():
+    """YYMMDD of the observing night; frames taken after midnight keep the evening's date."""
+    return (datetime.now() - timedelta(hours=12)).strftime('%y%m%d')
+
+class FrameCounter():
+    """Allocate consecutive frame file names, scanning the raw directory once per prefix."""
+    def __init__(self, rawdir: str = "./RAWDATA", extension: str = "fits"):
+        self.rawdir = rawdir
+        self.extension = extension
+        self.prefix = None
+        self.index = 0
+        self.lock = threading.Lock()
+
+    def scan(self, prefix):
+        pattern = re.compile(rf"{re.escape(prefix)}(\d{{4,}})\.{re.escape(self.extension)}$")
+        last = 0
+        try:
+            with os.scandir(self.rawdir) as entries:
+                for entry in entries:
+                    match = pattern.match(entry.name)
+                    if match:
+                        last = max(last, int(match.group(1)))
+        except FileNotFoundError:
+            pass
+        return last
+
+    def next(self, prefix: str = None):
+        prefix = prefix or observing_date()
+        with self.lock:
+            if prefix != self.prefix:
+                self.prefix = prefix
+                self.index = self.scan(prefix)
+            self.index += 1
+            return f"{self.rawdir}/{prefix}{self.index:04d}.{self.extension}"
+
+frame_counter = FrameCounter()
+
+def get_next_filename(prefix: str = None):
+    return frame_counter.next(prefix)
+
+# FITS files are written by a small thread pool. At most FITS_WRITERS frames are
+# written at once and FITS_BACKLOG more may wait; a frame is only read out once
+# it holds a slot, so a slow disk holds back new exposures instead of piling
+# frames up in memory.
+FITS_WRITERS = 2
+FITS_BACKLOG = 4
+fits_pool = ThreadPoolExecutor(max_workers=FITS_WRITERS, thread_name_prefix='fitswriter')
+fits_slots = None
+
+def write_fits(data, prefix=None):
+    """Write data as the next frame and return its file name.
+
+    The frame goes to a temporary file first; the frame number is taken and
+    the file linked into place only once the write succeeded, so a failed
+    write leaves no gap in the numbering. An existing file is never
+    replaced: if another writer took the name since the directory was
+    scanned, the next number is tried.
+    """
+    fd, tmpname = tempfile.mkstemp(suffix='.part', dir=frame_counter.rawdir)
+    os.close(fd)
+    try:
+        fits.HDUList([fits.PrimaryHDU(data)]).writeto(tmpname, overwrite=True)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+    try:
+        while True:
+            filename = frame_counter.next(prefix)
+            try:
+                os.link(tmpname, filename)
+                break
+            except FileExistsError:
+                continue
+    finally:
+        os.remove(tmpname)
+    return filename
+
+async def save_fits(read_frame, prefix=None):
+    """Wait for a writer slot, then read the frame with read_frame() and write it."""
+    global fits_slots
+    if fits_slots is None:
+        fits_slots = asyncio.Semaphore(FITS_WRITERS + FITS_BACKLOG)
+    async with fits_slots:
+        data = read_frame()
+        return await asyncio.get_running_loop().run_in_executor(fits_pool, write_fits, data, prefix)
 
 async def create_fits_image(exptime,shape: tuple = (100, 100), data_type=np.float32):
-    data = np.random.random(shape).astype(data_type)
-    hdu = fits.PrimaryHDU(data)
-    filename = get_next_filename()
-    hdul = fits.HDUList([hdu])
-    hdul.writeto(filename, overwrite=True)
     await asyncio.sleep(exptime)
+    filename = await save_fits(lambda: np.random.random(shape).astype(data_type))
     msg=f'FITS file {filename} is created.'
     response = {"status": "success", "message": msg, "file": filename, "process": 'Done'}
     return response
@@ -131,10 +212,8 @@ async def remaining(SPEC_server, exptime):
         remaining_time -= 10
         msg = f'Remaining exposure time: {remaining_time} seconds.'
         print('\033[32m' + '[SPEC]', msg + '\033[0m')
-        reply_data=mkmsg.specmsg()
-        reply_data.update(message=msg,process='ING')
-        rsp=json.dumps(reply_data)
-        await SPEC_server.send_message('ICS', rsp)
+        reply_data=mkmsg.SpecMessage(message=msg,process='ING')
+        await SPEC_server.send_message('ICS', reply_data)
 
 def spec_status():
     msg='Spectrograph Status is below. Spectrograph is ready.'
@@ -144,12 +223,12 @@ def get_bias(nframe):
     msg=f'Bias exposure finished. {nframe} Bias Frames are obtained.'
     return msg
 
-def get_flat(exptime,nframe):
+async def get_flat(exptime,nframe):
     msg=f'Flat exposure {exptime} seconds finished. {nframe} Flat Frames are obtained.' 
-    time.sleep(exptime)
+    await asyncio.sleep(float(exptime))
     return msg
 
-def get_arc(exptime,nframe):
+async def get_arc(exptime,nframe):
     msg=f'Arc exposure {exptime} finished. {nframe} Arc Frames are obtained.'
-    time.sleep(exptime)
+    await asyncio.sleep(float(exptime))
     return msg
@@ -9,9 +9,7 @@ import json
 
 def create_spec_command(func, **kwargs):
     """Helper function to create SPECTROGRAPH commands."""
-    cmd_data = mkmsg.specmsg()
-    cmd_data.update(func=func, **kwargs)
-    return json.dumps(cmd_data)
+    return mkmsg.SpecMessage(func=func, **kwargs)
 
 
 def spec_status(): return create_spec_command('specstatus', message ='Show spectrograph status.')
@@ -33,7 +31,8 @@ def get_arc(exptime,nframe):
     return create_spec_command('getarc', time=exptime, numframe=nframe, message =f'Get {nframe} arc images by {exptime} senconds exposure.')
 
 
-async def handle_spec(arg, ICS_client):
+async def handle_spec(arg, ICS_client, wait=False, timeout=None):
+    """Send a SPECTROGRAPH command. With wait=True, return its 'Done' reply."""
     cmd, *params = arg.split()
     command_map = {
         'specstatus': spec_status,
@@ -88,6 +87,8 @@ async def handle_spec(arg, ICS_client):
 
     if cmd in command_map:
         specmsg = command_map[cmd]()
+        if wait:
+            return await ICS_client.call("SPEC", specmsg, timeout)
         await ICS_client.send_message("SPEC", specmsg)
     else:
         print(f"Error: '{cmd}' is not right command for SPECTROGRAPH.")
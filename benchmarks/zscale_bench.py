@@ -0,0 +1,247 @@
+"""Benchmark Lib.zscale against the reference IRAF-style implementation.
+
+Checks that both return identical (z1, z2) on random frames (with and without
+a bad-pixel mask), that zscale_batch matches per-image zscale, and times them
+on a 4k x 4k frame and on a stack of small cutouts.
+
+    python benchmarks/zscale_bench.py
+"""
+import os, sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import math
+import time
+import numpy
+import Lib.zscale as zs
+
+# ---- Reference implementation (Lib/zscale.py before the vectorized rewrite) ----
+MAX_REJECT = 0.5
+MIN_NPIXELS = 5
+GOOD_PIXEL = 0
+BAD_PIXEL = 1
+KREJ = 2.5
+MAX_ITERATIONS = 5
+
+def ref_zscale (image, nsamples=1000, contrast=0.25, bpmask=None, zmask=None):
+    """Implement IRAF zscale algorithm
+    nsamples=1000 and contrast=0.25 are the IRAF display task defaults
+    bpmask and zmask not implemented yet
+    image is a 2-d numpy array
+    returns (z1, z2)
+    """
+
+    # Sample the image
+    samples = ref_sample (image, nsamples, bpmask, zmask)
+    npix = len(samples)
+    samples.sort()
+    zmin = samples[0]
+    zmax = samples[-1]
+    # For a zero-indexed array
+    center_pixel = int((npix - 1) / 2)  #20210728 by hilee
+    if npix%2 == 1:
+        median = samples[center_pixel]
+    else:
+        median = 0.5 * (samples[center_pixel] + samples[center_pixel + 1])
+
+    #
+    # Fit a line to the sorted array of samples
+    minpix = max(MIN_NPIXELS, int(npix * MAX_REJECT))
+    ngrow = max (1, int (npix * 0.01))
+    ngoodpix, zstart, zslope = ref_fit_line (samples, npix, KREJ, ngrow,
+                                             MAX_ITERATIONS)
+
+    if ngoodpix < minpix:
+        z1 = zmin
+        z2 = zmax
+    else:
+        if contrast > 0: 
+            zslope = zslope / contrast
+        z1 = max (zmin, median - (center_pixel - 1) * zslope)
+        z2 = min (zmax, median + (npix - center_pixel) * zslope)
+    return z1, z2
+
+def ref_sample (image, maxpix, bpmask=None, zmask=None):
+
+    # Figure out which pixels to use for the zscale algorithm
+    # Returns the 1-d array samples
+    # Don't worry about the bad pixel mask or zmask for the moment
+    # Sample in a square grid, and return the first maxpix in the sample
+    nc = image.shape[0]
+    nl = image.shape[1]
+    stride = max (1.0, math.sqrt((nc - 1) * (nl - 1) / float(maxpix)))
+    stride = int (stride)
+
+    sample_image = image[::stride,::stride]
+
+    masks = [numpy.zeros(sample_image.shape, dtype=bool)]
+
+    for m in [zmask, bpmask]:
+        if m is not None: 
+            masks.append(m[::stride,::stride].astype(bool))
+
+    msk = numpy.max(masks, axis=0)
+
+    samples = sample_image[~msk]
+    return samples[:maxpix]
+
+def ref_fit_line (samples, npix, krej, ngrow, maxiter):
+
+    #
+    # First re-map indices from -1.0 to 1.0
+    xscale = 2.0 / (npix - 1)
+    xnorm = numpy.arange(npix)
+    xnorm = xnorm * xscale - 1.0
+
+    ngoodpix = npix
+    minpix = max (MIN_NPIXELS, int (npix*MAX_REJECT))
+    last_ngoodpix = npix + 1
+
+    # This is the mask used in k-sigma clipping.  0 is good, 1 is bad
+    badpix = numpy.zeros(npix, dtype="int32")
+
+    #
+    #  Iterate
+
+    for niter in range(maxiter):
+
+        if (ngoodpix >= last_ngoodpix) or (ngoodpix < minpix):
+            break
+
+        # Accumulate sums to calculate straight line fit
+        goodpixels = numpy.where(badpix == GOOD_PIXEL)
+        sumx = xnorm[goodpixels].sum()
+        sumxx = (xnorm[goodpixels]*xnorm[goodpixels]).sum()
+        sumxy = (xnorm[goodpixels]*samples[goodpixels]).sum()
+        sumy = samples[goodpixels].sum()
+        sum = len(goodpixels[0])
+
+        delta = sum * sumxx - sumx * sumx
+        # Slope and intercept
+        intercept = (sumxx * sumy - sumx * sumxy) / delta
+        slope = (sum * sumxy - sumx * sumy) / delta
+
+        # Subtract fitted line from the data array
+        fitted = xnorm*slope + intercept
+        flat = samples - fitted
+
+        # Compute the k-sigma rejection threshold
+        ngoodpix, mean, sigma = ref_compute_sigma (flat, badpix, npix)
+
+        threshold = sigma * krej
+
+        # Detect and reject pixels further than k*sigma from the fitted line
+        lcut = -threshold
+        hcut = threshold
+        below = numpy.where(flat < lcut)
+        above = numpy.where(flat > hcut)
+
+        badpix[below] = BAD_PIXEL
+        badpix[above] = BAD_PIXEL
+
+        # Convolve with a kernel of length ngrow
+        kernel = numpy.ones(ngrow,dtype="int32")
+        badpix = numpy.convolve(badpix, kernel, mode='same')
+
+        ngoodpix = len(numpy.where(badpix == GOOD_PIXEL)[0])
+
+        niter += 1
+
+    # Transform the line coefficients back to the X range [0:npix-1]
+    zstart = intercept - slope
+    zslope = slope * xscale
+
+    return ngoodpix, zstart, zslope
+
+def ref_compute_sigma (flat, badpix, npix):
+
+    # Compute the rms deviation from the mean of a flattened array.
+    # Ignore rejected pixels
+
+    # Accumulate sum and sum of squares
+    goodpixels = numpy.where(badpix == GOOD_PIXEL)
+    sumz = flat[goodpixels].sum()
+    sumsq = (flat[goodpixels]*flat[goodpixels]).sum()
+    ngoodpix = len(goodpixels[0])
+    if ngoodpix == 0:
+        mean = None
+        sigma = None
+    elif ngoodpix == 1:
+        mean = sumz
+        sigma = None
+    else:
+        mean = sumz / ngoodpix
+        temp = sumsq / (ngoodpix - 1) - sumz*sumz / (ngoodpix * (ngoodpix - 1))
+        if temp < 0:
+            sigma = 0.0
+        else:
+            sigma = math.sqrt (temp)
+
+    return ngoodpix, mean, sigma
+# ---- End of reference implementation ----
+
+
+def check(ntrial=200, seed=1):
+    rng = numpy.random.default_rng(seed)
+    for i in range(ntrial):
+        ny, nx = rng.integers(20, 600, 2)
+        image = rng.normal(1000., 30., (ny, nx))
+        if i % 3 == 0:
+            image += rng.exponential(500., (ny, nx)) * (rng.random((ny, nx)) < 0.05)
+        if i % 4 == 0:
+            image = image.astype(numpy.int16)
+        nsamples = int(rng.choice([100, 1000, 5000]))
+        bpmask = rng.random((ny, nx)) < 0.1 if i % 2 else None
+        ref = ref_zscale(image, nsamples=nsamples, bpmask=bpmask)
+        new = zs.zscale(image, nsamples=nsamples, bpmask=bpmask)
+        assert ref == new, f'trial {i}: reference {ref} != zscale {new}'
+    print(f'{ntrial} random frames: identical (z1, z2)')
+
+
+def check_batch(ntrial=20, seed=3):
+    rng = numpy.random.default_rng(seed)
+    for i in range(ntrial):
+        nimage = int(rng.integers(1, 50))
+        ny, nx = rng.integers(20, 200, 2)
+        stack = rng.normal(1000., 30., (nimage, ny, nx))
+        batch = zs.zscale_batch(stack)
+        for image, (z1, z2) in zip(stack, batch):
+            ref = ref_zscale(image)
+            assert numpy.allclose(ref, (z1, z2), rtol=1e-12, atol=0), f'trial {i}: reference {ref} != batch {(z1, z2)}'
+    print(f'{ntrial} random stacks: zscale_batch matches per-image zscale')
+
+
+def bench_batch(shape=(500, 32, 32), nrepeat=5):
+    stack = numpy.random.default_rng(4).normal(1000., 30., shape).astype(numpy.float32)
+    start = time.perf_counter()
+    for _ in range(nrepeat):
+        [zs.zscale(image) for image in stack]
+    tloop = (time.perf_counter() - start) / nrepeat
+    start = time.perf_counter()
+    for _ in range(nrepeat):
+        zs.zscale_batch(stack)
+    tbatch = (time.perf_counter() - start) / nrepeat
+    print(f'{shape[0]} cutouts of {shape[1]}x{shape[2]}: per-image loop {tloop*1e3:.1f} ms, '
+          f'zscale_batch {tbatch*1e3:.1f} ms, speedup {tloop/tbatch:.1f}x')
+
+
+def timeit(func, image, nrepeat, **kwargs):
+    start = time.perf_counter()
+    for _ in range(nrepeat):
+        z = func(image, **kwargs)
+    return (time.perf_counter() - start) / nrepeat, z
+
+
+def bench(shape=(4096, 4096), nrepeat=50):
+    image = numpy.random.default_rng(2).normal(1000., 30., shape).astype(numpy.float32)
+    for nsamples in (1000, 100000):
+        tref, zref = timeit(ref_zscale, image, nrepeat, nsamples=nsamples)
+        tnew, znew = timeit(zs.zscale, image, nrepeat, nsamples=nsamples)
+        assert zref == znew
+        print(f'{shape[0]}x{shape[1]} nsamples={nsamples}: reference {tref*1e3:.3f} ms, '
+              f'zscale {tnew*1e3:.3f} ms, speedup {tref/tnew:.1f}x, (z1, z2) = {znew}')
+
+
+if __name__ == '__main__':
+    check()
+    check_batch()
+    bench()
+    bench_batch()
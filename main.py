@@ -13,6 +13,12 @@ from astropy.io import fits
 from Lib.AMQ import AMQclass
 import Lib.mkmessage as mkmsg
 import Lib.zscale as zs
+from Lib.fitsload import open_arms, close_arms
+from Lib.render import RenderCache
+from Lib.ingest import LatestOnly, Superseded
+import Lib.specload as specload
+from Lib.logsink import setup_logging
+from Lib.router import Router, BoundedQueue
 #from LAMP.lampcli import handle_lamp
 import json
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
@@ -22,7 +28,7 @@ import numpy as np
 
 
 class MplCanvas(FigureCanvas):
-    def __init__(self, parent=None,dpi=100,left=0.00,right=1.,bottom=0.0,top=1.):
+    def __init__(self, parent=None,dpi=100,left=0.00,right=1.,bottom=0.0,top=1.,renders=None):
         self.fig = Figure(dpi=dpi)
         self.ax = self.fig.add_subplot(111)
         self.fig.subplots_adjust(left=left,right=right,bottom=bottom,top=top) 
@@ -42,20 +48,149 @@ class MplCanvas(FigureCanvas):
         self._initial_xlim = None
         self._initial_ylim = None
 
+        # Memory-mapped frame behind the image, re-read for the visible region after zoom/pan
+        self.frame = None
+        self.image = None
+        self.clim = None
+        self.cmap = 'gray'
+        # Frames are drawn from RGBA renders, shared with other canvases through renders
+        self.renders = renders if renders is not None else RenderCache(maxsize=2)
+        # Spectrum behind the line, re-decimated to the visible range after zoom/pan
+        self.spectrum = None
+        self.line = None
+        self._refine_timer = QTimer(self)
+        self._refine_timer.setSingleShot(True)
+        self._refine_timer.setInterval(150)
+        self._refine_timer.timeout.connect(self.refine_view)
+
+        # Pan/zoom redraws are coalesced to at most MAX_FPS per second; while
+        # dragging an image only the image artist is redrawn over a cached background.
+        self._redraw_timer = QTimer(self)
+        self._redraw_timer.setSingleShot(True)
+        self._redraw_timer.setInterval(1000 // self.MAX_FPS)
+        self._redraw_timer.timeout.connect(self._flush_redraw)
+        self._background = None
+
+    MAX_FPS = 30
+
+    def request_redraw(self):
+        """Schedule a redraw; requests arriving before it runs are merged into it."""
+        if not self._redraw_timer.isActive():
+            self._redraw_timer.start()
+
+    def _flush_redraw(self):
+        if self.spectrum is not None:
+            self.update_line()
+        if self._background is not None:
+            self.restore_region(self._background)
+            self.ax.draw_artist(self.image)
+            self.blit(self.ax.bbox)
+        else:
+            self.draw_idle()
+
+    def _start_blit(self):
+        # Render everything except the image once and keep it as the drag background
+        if self.image is None:
+            return
+        self.image.set_animated(True)
+        self.draw()
+        self._background = self.copy_from_bbox(self.ax.bbox)
+
+    def _end_blit(self):
+        if self._background is None:
+            return
+        self._background = None
+        if self.image is not None:
+            self.image.set_animated(False)
+        self.draw_idle()
+
+    def resizeEvent(self, event):
+        self._end_blit()
+        super().resizeEvent(event)
+
     def imshows(self, data, **kwargs):
+        """Show data. An image of the same shape and origin is updated in place
+        (set_data/set_clim), keeping the axes, ticks and current zoom."""
+        self.frame = None
+        self._end_blit()
+        if self.image is not None and self.image.get_array().shape == data.shape \
+                and self.image.origin == kwargs.get('origin', self.image.origin):
+            self.image.set_data(data)
+            if kwargs.get('vmin') is None or kwargs.get('vmax') is None:
+                self.image.autoscale()
+            self.image.set_clim(kwargs.get('vmin'), kwargs.get('vmax'))
+            if 'cmap' in kwargs:
+                self.image.set_cmap(kwargs['cmap'])
+            if 'extent' in kwargs and tuple(kwargs['extent']) != tuple(self.image.get_extent()):
+                self.image.set_extent(kwargs['extent'])
+            self.draw_idle()
+            return
+
         self.ax.clear()
-        self.ax.imshow(data, **kwargs)
+        self.spectrum = None
+        self.line = None
+        self.image = self.ax.imshow(data, **kwargs)
         self.ax.axis('on')
         self._initial_xlim = self.ax.get_xlim()
         self._initial_ylim = self.ax.get_ylim()
         self.draw()
 
+    def show_frame(self, frame, clim, cmap='gray'):
+        """Show a FitsFrame: a decimated preview first, full resolution once zoomed in."""
+        rgba, extent = self.renders.render(frame, frame.preview_plan(), clim, cmap)
+        self.imshows(rgba, extent=extent, origin='lower')
+        self.ax.set_autoscale_on(False)
+        self.clim, self.cmap = clim, cmap
+        self.frame = frame
+        # The preview may be coarser than the (kept) zoom: re-read the visible region
+        self._refine_timer.start()
+
+    def refine_view(self):
+        """Re-read the frame for the visible region at the widget's pixel resolution."""
+        if self.spectrum is not None:
+            self.update_line()
+            self.draw_idle()
+            return
+        if self.frame is None or self.image is None:
+            return
+        x0, x1 = sorted(self.ax.get_xlim())
+        y0, y1 = sorted(self.ax.get_ylim())
+        plan = self.frame.plan(x0, x1, y0, y1, self.width(), self.height())
+        rgba, extent = self.renders.render(self.frame, plan, self.clim, self.cmap)
+        self.image.set_data(rgba)
+        self.image.set_extent(extent)
+        self.draw_idle()
+
     def plots(self,wave,flux):
-        self.ax.clear()
-        self.ax.plot(wave,flux,'k-')
-        self.ax.axis('on')
+        """Plot a spectrum on a persistent line, drawn as a min/max envelope per
+        screen pixel and as raw samples once zoomed in far enough."""
+        self._end_blit()
+        wave, flux = np.asarray(wave), np.asarray(flux)
+        if np.any(np.diff(wave) < 0):
+            order = np.argsort(wave, kind='stable')
+            wave, flux = wave[order], flux[order]
+        self.spectrum = (wave, flux)
+
+        if self.line is None:
+            self.ax.clear()
+            self.image = None
+            self.frame = None
+            (self.line,) = self.ax.plot([], [], 'k-')
+            self.ax.axis('on')
+
+        self.line.set_data(*specload.minmax_envelope(wave, flux, -np.inf, np.inf, self.width()))
+        self.ax.set_autoscale_on(True)
+        self.ax.relim()
+        self.ax.autoscale_view()
+        self._initial_xlim = self.ax.get_xlim()
+        self._initial_ylim = self.ax.get_ylim()
+        self.update_line()
         self.draw()
 
+    def update_line(self):
+        x0, x1 = sorted(self.ax.get_xlim())
+        self.line.set_data(*specload.minmax_envelope(*self.spectrum, x0, x1, self.width()))
+
     def wheelEvent(self, event):
         # Expand and contract
         x_min, x_max = self.ax.get_xlim()
@@ -69,18 +204,21 @@ class MplCanvas(FigureCanvas):
 
         self.ax.set_xlim([x_center - x_range / 2, x_center + x_range / 2])
         self.ax.set_ylim([y_center - y_range / 2, y_center + y_range / 2])
-        self.draw()
+        self.request_redraw()
+        self._refine_timer.start()
 
     def mousePressEvent(self, event: QMouseEvent):
         if event.button() == Qt.MouseButton.LeftButton:
             self._is_dragging = True
             self._last_mouse_pos = event.position()
+            self._start_blit()
         elif event.button() == Qt.MouseButton.RightButton:
             # Right click for reset
             if self._initial_xlim and self._initial_ylim:
                 self.ax.set_xlim(self._initial_xlim)
                 self.ax.set_ylim(self._initial_ylim)
                 self.draw()
+                self._refine_timer.start()
 
     def mouseMoveEvent(self, event: QMouseEvent):
         if self._is_dragging and self._last_mouse_pos:
@@ -95,13 +233,70 @@ class MplCanvas(FigureCanvas):
 
             self.ax.set_xlim(x_min - dx * x_range / self.width(), x_max - dx * x_range / self.width())
             self.ax.set_ylim(y_min + dy * y_range / self.height(), y_max + dy * y_range / self.height())
-            self.draw()
+            self.request_redraw()
 
             self._last_mouse_pos = current_pos
 
     def mouseReleaseEvent(self, event: QMouseEvent):
         if event.button() == Qt.MouseButton.LeftButton:
             self._is_dragging = False
+            self._end_blit()
+            self._refine_timer.start()
+
+
+REDUCEDDIR = '/media/shyunc/DATA/KSpec/Reduced/'
+REFERENCE_SPECTRA = {'SDCH': REDUCEDDIR+'SDCH_20190322_009522.txt', 'SDCK': REDUCEDDIR+'SDCK_20190322_009522.txt'}
+
+
+def read_spec(framefile=None):
+    """B (SDCH) and R (SDCK) reduced spectra of framefile; the reference spectra stand in until they exist."""
+    paths = dict(REFERENCE_SPECTRA)
+    if framefile is not None:
+        paths.update(specload.find_reduced(framefile, REDUCEDDIR))
+    return specload.load_spectrum(paths['SDCH']), specload.load_spectrum(paths['SDCK'])
+
+
+def ingest_frame(stale, filepath, renders):
+    """Worker side of MainWindow.reload_img: open, scale and decimate the frame of
+    each arm, render the previews, read the spectra."""
+    ingested = {'frames': None, 'error': None, 'spectra': None, 'spectra_error': None}
+    try:
+        frames = open_arms(filepath)
+        ingested['frames'] = frames
+        zlims = {}
+        for arm, frame in frames.items():
+            # Arms sharing one frame share its zscale, pyramid and render
+            same = [other for other in zlims if frames[other] is frame]
+            if same:
+                zlims[arm] = zlims[same[0]]
+                continue
+            zlims[arm] = frame.zscale()
+            if not stale():
+                frame.build_pyramid()
+                renders.render(frame, frame.preview_plan(), zlims[arm], 'gray')
+        ingested['zlim'] = zlims
+    except Exception as e:
+        ingested['error'] = e
+
+    # A missing or unreadable spectrum must not cost the image
+    if not stale():
+        try:
+            ingested['spectra'] = read_spec(filepath)
+        except Exception as e:
+            ingested['spectra_error'] = e
+    if stale():
+        release_frames(ingested['frames'], renders)
+        return None
+    return ingested
+
+
+def release_frames(frames, renders):
+    """Close the frames of an ingest and drop their renders (frames may be None)."""
+    if frames is None:
+        return
+    for frame in frames.values():
+        renders.forget(frame)
+    close_arms(frames)
 
 
 class MainWindow(QMainWindow):
@@ -122,10 +317,25 @@ class MainWindow(QMainWindow):
         self.ui = Ui_MainWindow()
         self.ui.setupUi(self)
 
-        self.response_queue = asyncio.Queue()
-        self.GFA_response_queue = asyncio.Queue()
-        self.ADC_response_queue = asyncio.Queue()
-        self.SPEC_response_queue = asyncio.Queue()
+        with open('./Lib/KSPEC.ini', 'r') as f:
+            kspecinfo = json.load(f)
+        self.log = setup_logging(self.ui.log, kspecinfo.get('LOG'))
+
+        # Bounded, with a policy per subsystem (QUEUES section of KSPEC.ini; unbounded if missing).
+        # Command replies reach their caller through ICS_client.call, not these queues;
+        # response_queue is a lossy sink for everything else.
+        queues = kspecinfo.get('QUEUES', {})
+        self.response_queue = BoundedQueue(**queues.get('response', {}))
+        self.GFA_response_queue = BoundedQueue(**queues.get('GFA', {}))
+        self.ADC_response_queue = BoundedQueue(**queues.get('ADC', {}))
+        self.SPEC_response_queue = BoundedQueue(**queues.get('SPEC', {}))
+        self.router = None
+        self.route_clock = QElapsedTimer()
+        self.route_clock.start()
+
+        self.frames = None
+        self.ingest = LatestOnly()
+        self.renders = RenderCache()
 
 
 #Make timer (LT & UTC) 
@@ -153,11 +363,11 @@ class MainWindow(QMainWindow):
         self.ui.pushbtn_start_sequence.clicked.connect(self.take_image)
 
         # Canvas setting
-        self.canvas_B=MplCanvas(self,dpi=100,left=0.00,right=1.,bottom=0.0,top=1.)
+        self.canvas_B=MplCanvas(self,dpi=100,left=0.00,right=1.,bottom=0.0,top=1.,renders=self.renders)
         self.B_layout=QVBoxLayout(self.ui.frame_B)
         self.B_layout.addWidget(self.canvas_B)
 
-        self.canvas_R=MplCanvas(self,dpi=100,left=0.00,right=1.,bottom=0.0,top=1.)
+        self.canvas_R=MplCanvas(self,dpi=100,left=0.00,right=1.,bottom=0.0,top=1.,renders=self.renders)
         self.R_layout=QVBoxLayout(self.ui.frame_R)
         self.R_layout.addWidget(self.canvas_R)
 
@@ -205,18 +415,31 @@ class MainWindow(QMainWindow):
             kspecinfo['RabbitMQ']['ip_addr'],
             kspecinfo['RabbitMQ']['idname'],
             kspecinfo['RabbitMQ']['pwd'],
-            'ICS', 'ics.ex'
+            'ICS', 'ics.ex',
+            prefetch_count=kspecinfo['RabbitMQ'].get('prefetch_count',0),
+            ack_batch=kspecinfo['RabbitMQ'].get('ack_batch',1),
+            confirm_window=kspecinfo['RabbitMQ'].get('confirm_window',0),
+            codec=kspecinfo['RabbitMQ'].get('codec','json')
         )
 
         react = await self.ICS_client.connect()
-        self.ui.log.appendPlainText(react)
+        self.log.info(react)
 #        self.ui.log_2.appendPlainText(react)
         #self.processlog.append(react)
         react = await self.ICS_client.define_producer()
-        self.ui.log.appendPlainText(react)
+        self.log.info(react)
         await self.ICS_client.define_consumer()
+        self.router = self.build_router()
         asyncio.create_task(self.wait_for_response())
 
+    def build_router(self):
+        """Progress (ING) messages of the subsystems go to their own queues, everything else to response_queue."""
+        router = Router(self.response_queue)
+        router.add('GFA', 'ING', self.GFA_response_queue)
+        router.add('ADC', 'ING', self.ADC_response_queue)
+        router.add('SPEC', 'ING', self.SPEC_response_queue)
+        return router
+
 
 
     def autoguiding(self):
@@ -224,76 +447,83 @@ class MainWindow(QMainWindow):
         guidenum=['1','2','3','4']
         G_canvas=[self.canvas_G1,self.canvas_G2,self.canvas_G3,self.canvas_G4]
 
-        for i,can in enumerate(G_canvas):
+        cutouts=[]
+        for i in range(len(G_canvas)):
             with fits.open(cutimgpath+'cutout_fluxmax_'+str(i+1)+'.fits') as hdul:
-                data=hdul[0].data
+                cutouts.append(hdul[0].data)
 
-            self.G_zmin, self.G_zmax = zs.zscale(data)
+        limits=zs.zscale_batch(cutouts)
+        for can,data,(self.G_zmin,self.G_zmax) in zip(G_canvas,cutouts,limits):
             can.imshows(data,vmin=self.G_zmin,vmax=self.G_zmax,cmap='gray',origin='lower')
         
 
 
     @asyncSlot()
     async def take_image(self):
-        await handle_spec('getobj 3 1', self.ICS_client)
-        self.ui.log.appendPlainText("sent message to device 'SPEC'. message: Get 1 bias images.")
-        msg=await self.response_queue.get()
+        self.log.info("sent message to device 'SPEC'. message: Get 1 bias images.")
+        try:
+            msg=await handle_spec('getobj 3 1', self.ICS_client, wait=True, timeout=60)
+        except asyncio.TimeoutError:
+            self.log.warning("No reply from SPEC within 60 seconds.")
+            return
 #        self.ui.log.appendPlainText(f"{msg['file']}")
+        if msg.status != 'success':
+            self.log.error(f"SPEC exposure failed: {msg.message}")
+            return
 
-        filename=msg['file']
+        filename=msg.file
 
-        self.reload_img(filename)
+        await self.reload_img(filename)
 
 
-    def reload_img(self,filename):
+    async def reload_img(self,filename):
         rawdir='/media/shyunc/DATA/KSpec/RAWDATA/'
         filepath=os.path.join(rawdir,filename)
 
+        # File I/O and numerics run in the ingest pool; only drawing happens here.
         try:
-            with fits.open(filepath) as hdul:
-                data = hdul[0].data
-
-            # Z-scale 계산
-            self.zmin, self.zmax = zs.zscale(data)
-
-            # 기존 캔버스 초기화
-            self.canvas_B.imshows(
-                data,
-                vmin=self.zmin,
-                vmax=self.zmax,
-                cmap='gray',
-                origin='lower'
-             )
-
-            self.canvas_R.imshows(
-                data,
-                vmin=self.zmin,
-                vmax=self.zmax,
-                cmap='gray',
-                origin='lower'
-             )
-
-#            self.canvas.ax.axis('off')
-#            self.canvas.draw()
-
-            self.ui.log.appendPlainText(f"Loaded image: {filename}")
-
-        except Exception as e:
-            print(f"[ERROR] Could not load image {filepath}: {e}")
-            self.ui.log.appendPlainText(f"Failed to load image: {e}")
-            
-
-        self.load_spec()
+            ingested = await self.ingest.run(ingest_frame, filepath, self.renders,
+                                             discard=lambda ingested: release_frames(ingested['frames'], self.renders))
+        except Superseded:
+            return      # A newer frame is being loaded
+        if ingested is None:
+            return
+
+        frames = ingested['frames']
+        try:
+            if ingested['error'] is None:
+                self.zmin, self.zmax = ingested['zlim']['B']
+
+                # 기존 캔버스 초기화
+                self.canvas_B.show_frame(frames['B'], ingested['zlim']['B'], cmap='gray')
+                self.canvas_R.show_frame(frames['R'], ingested['zlim']['R'], cmap='gray')
+
+#                self.canvas.ax.axis('off')
+#                self.canvas.draw()
+                frames, self.frames = self.frames, frames     # The previous frames are closed below
+
+                self.log.info(f"Loaded image: {filename}")
+            else:
+                print(f"[ERROR] Could not load image {filepath}: {ingested['error']}")
+                self.log.error(f"Failed to load image: {ingested['error']}")
+        finally:
+            release_frames(frames, self.renders)
+
+        if ingested['spectra_error'] is None:
+            self.load_spec(ingested['spectra'])
+        else:
+            print(f"[ERROR] Could not load spectra of {filepath}: {ingested['spectra_error']}")
+            self.log.error(f"Failed to load reduced spectrum: {ingested['spectra_error']}")
 
 
 
-    def load_spec(self):
-        waveb,fluxb = np.loadtxt('/media/shyunc/DATA/KSpec/Reduced/SDCH_20190322_009522.txt',skiprows=1,dtype=float,unpack=True,usecols=(0,1))
+    def load_spec(self, spectra=None):
+        if spectra is None:
+            spectra = read_spec()
+        (waveb,fluxb),(waver,fluxr) = spectra
         self.canvas_spec_B.plots(waveb,fluxb)
-
-        waver,fluxr = np.loadtxt('/media/shyunc/DATA/KSpec/Reduced/SDCK_20190322_009522.txt',skiprows=1,dtype=float,unpack=True,usecols=(0,1))
         self.canvas_spec_R.plots(waver,fluxr)
-        self.ui.log.appendPlainText(f"Reduced spectrum loaded.")
+        self.log.info(f"Reduced spectrum loaded.")
 
 
 
@@ -303,32 +533,18 @@ class MainWindow(QMainWindow):
         """
         Waits for responses from the K-SPEC sub-system and distributes then appropriately.
         """
-        while True:
+        router = self.router
+        async for response_data in self.ICS_client.consume("ICS"):
             try:
-                response = await self.ICS_client.receive_message("ICS")
-                response_data = json.loads(response)
-                inst=response_data['inst']
-                message=response_data.get('message','No message')
-                self.ui.log.appendPlainText(message)
+                # No serialization here: the handlers format the message as text
+                self.log.info('%s', response_data.message)
                 #self.processlog.append(message)
 
-                if isinstance(message,dict):
-                    message = json.dumps(message, indent=2)
-                    print(f'\033[94m[ICS] received from {inst}: {message}\033[0m\n', flush=True)
-                else:
-                    print(f'\033[94m[ICS] received from {inst}: {response_data["message"]}\033[0m\n', flush=True)
-
-                queue_map = {"GFA": self.GFA_response_queue, "ADC": self.ADC_response_queue, "SPEC": self.SPEC_response_queue}
-                if response_data['inst'] in queue_map and response_data['process'] == 'ING':
-#                    print(f'put in {response_data["inst"]}: {response_data}')
-                    await queue_map[response_data['inst']].put(response_data)
-#                elif response_data['inst'] == 'SPEC' and response_data['process'] == 'Done':
-#                    await self.SPEC_response_queue.put(response_data)
-                else:
-                    await self.response_queue.put(response_data)
-#                    print(f'response_queue formation: {response_data}')
+                if self.ICS_client.resolve(response_data):
+                    continue
+                await router.dispatch(response_data)
             except Exception as e:
-                print(f"Error in wait_for_response: {e}", flush=True)
+                self.log.error(f"Error in wait_for_response: {e}")
         
 
 #Close Event : to prevent to close the window easily
@@ -337,6 +553,8 @@ class MainWindow(QMainWindow):
                     QMessageBox.Yes|QMessageBox.No)
 
         if re == QMessageBox.Yes:
+            for handler in self.log.handlers:
+                handler.close()
             QCloseEvent.accept()
         else:
             QCloseEvent.ignore() 
@@ -349,6 +567,10 @@ class MainWindow(QMainWindow):
         if id(sender) == id(self.timer):
             self.ui.lcd_lt.display(currentTime)
             self.ui.lcd_utc.display(currentutc)
+            # Per-route message counts and queue depths, once a minute
+            if self.router is not None and self.route_clock.elapsed() >= 60000:
+                self.route_clock.restart()
+                self.log.debug(f'Inbound routes: {self.router.summary()}')
 
 #    def load_data(self, 
 